@@ -2,16 +2,33 @@
 #
 # Data are taken from "[ID].bin"
 # Timestamps are reconstructed from the config file "[ID].config"
-# Output will be named "[ID].csv"
+# Output will be named "[ID].csv" (and "[ID].columns", see EXPORT_COLUMNAR)
 #
 # Stanley H.I. Lio
 # hlio@hawaii.edu
 # MESHLAB, UH Manoa
-import struct, math, sys, csv, json, logging
+import sys, json, logging
 from datetime import datetime
 from glob import glob
 from os.path import join, exists, basename, isdir, isfile
-from common import SPI_FLASH_PAGE_SIZE_BYTE, SAMPLE_INTERVAL_CODE_MAP, SAMPLE_SIZE_BYTE, ts2dt, dt2ts
+from common import SPI_FLASH_PAGE_SIZE_BYTE, TimeAxis, ts2dt, dt2ts, ts2datetime64
+from sample_codec import decode_tuples
+from download_manifest import check_complete
+
+
+CSV_HEADER = ['UTC_datetime', 'posix_timestamp', 'T_DegC', 'P_kPa', 'ambient_light_hdr', 'white_light_hdr', 'red', 'green', 'blue', 'white']
+# what csv.writer would write for (datetime, posix_timestamp, T, P, als, white light, r, g, b, w)
+CSV_ROW = '%s,%r,%.4f,%.3f,%d,%d,%d,%d,%d,%d\r\n'
+# convert this many pages (12 samples each) at a time
+BATCH_PAGE_COUNT = 4096
+# number of conversion processes, here (see bin2csv_sharded()), in bin2csv_batch.py and in
+# read_memory_batch.py. None = one per CPU core.
+CONVERSION_WORKERS = None
+# don't split a .bin into pieces smaller than this (in page) to spread it across processes
+MIN_SHARD_PAGE_COUNT = 1024
+# Also write "[ID].columns", the same data in binary columns that load without parsing (see columnar.py).
+# Wherever a CSV is made from a .bin: here, read_memory.py, read_memory_batch.py and bin2csv_batch.py.
+EXPORT_COLUMNAR = True
 
 
 def find(pattern, *_, dironly=False, fileonly=False, default=None):
@@ -54,42 +71,167 @@ def find(pattern, *_, dironly=False, fileonly=False, default=None):
                 # take the input as the index
                 return FN[int(r) - 1]
 
-def construct_timestamp(logging_start_time, sample_count, interval_second):
-    ts = list(range(0, sample_count))
-    return [x*interval_second + logging_start_time for x in ts]
+def count_csv_rows(fn_csv):
+    """Number of data rows (header excluded) in a CSV file written by bin2csv()."""
+    n = 0
+    with open(fn_csv, 'rb') as fin:
+        for buf in iter(lambda: fin.read(1024*1024), b''):
+            n += buf.count(b'\n')
+    return max(n - 1, 0)
+
+def bin2csv(fn_bin, fn_csv, config, append=False, batch_page_count=BATCH_PAGE_COUNT):
+    """If append is True and fn_csv already exists, only convert the samples in fn_bin that come
+    after those already in fn_csv, and add them to the end of it.
+    fn_bin is read, decoded and written out batch_page_count pages at a time, so memory use
+    doesn't grow with the size of the file. An incomplete download is refused (RuntimeError)."""
+    check_complete(fn_bin)
+    skip = count_csv_rows(fn_csv) if append and exists(fn_csv) else 0
+    first_page, drop = resume_point(page_sample_counts(fn_bin), skip) if skip else (0, 0)
 
-def bin2csv(fn_bin, fn_csv, config):
-    logging.debug('Reading and parsing binary file...')
-    D = []
+    logging.debug('Converting {} to {}...'.format(fn_bin, fn_csv))
+    with open(fn_csv, 'a' if skip else 'w', newline='') as fout:
+        if not skip:
+            fout.write(','.join(CSV_HEADER) + '\r\n')
+        convert_pages(fn_bin, fout, config, first_page, None, skip, drop, batch_page_count)
+
+def page_sample_counts(fn_bin, batch_page_count=BATCH_PAGE_COUNT):
+    """flash_pages.sample_counts() of every page of fn_bin, read batch_page_count pages at a time."""
+    from flash_pages import sample_counts
+    counts = []
     with open(fn_bin, 'rb') as fin:
-        while True:
-            page = fin.read(SPI_FLASH_PAGE_SIZE_BYTE)
-            if len(page) < SPI_FLASH_PAGE_SIZE_BYTE:
+        for buf in iter(lambda: fin.read(batch_page_count*SPI_FLASH_PAGE_SIZE_BYTE), b''):
+            counts.extend(sample_counts(buf))
+    return counts
+
+def resume_point(counts, skip):
+    """(page, number of its samples to leave out) of sample number `skip`, given the number of
+    samples in every page (see page_sample_counts()). Not every page but the last is full: a page
+    can end early at a NaN sample anywhere in the file. (len(counts), 0) if there is no such sample."""
+    for k, n in enumerate(counts):
+        if skip < n:
+            return k, skip
+        skip -= n
+    return len(counts), 0
+
+def convert_pages(fn_bin, fout, config, first_page, page_count, first, drop=0, batch_page_count=BATCH_PAGE_COUNT):
+    """Write the CSV rows (no header) of page_count pages (all the rest if None) of fn_bin from
+    first_page on to fout, leaving out the first `drop` samples. The first sample written is
+    sample number `first`."""
+    with open(fn_bin, 'rb') as fin:
+        fin.seek(first_page*SPI_FLASH_PAGE_SIZE_BYTE)
+        while page_count is None or page_count > 0:
+            n = batch_page_count if page_count is None else min(batch_page_count, page_count)
+            buf = fin.read(n*SPI_FLASH_PAGE_SIZE_BYTE)
+            if not len(buf):
                 break
+            # each page up to its first NaN sample (see sample_codec.py)
+            D = decode_tuples(buf)[drop:]
+            drop = 0
+            fout.write(csv_block(D, config, first=first))
+            first += len(D)
+            if page_count is not None:
+                page_count -= n
+
+def convert_shard(fn_bin, fn_part, config, first_page, page_count, first, drop):
+    """convert_pages() into the file fn_part. Runs in a worker process."""
+    with open(fn_part, 'w', newline='') as fout:
+        convert_pages(fn_bin, fout, config, first_page, page_count, first, drop)
+
+def bin2csv_sharded(fn_bin, fn_csv, config, append=False, workers=CONVERSION_WORKERS):
+    """Same as bin2csv(), with the work split across processes: fn_bin is cut into page ranges
+    (a sample never straddles two pages), each converted to its own part file by a worker, and
+    the parts are joined in order. Which sample number each range starts at comes from counting
+    the samples of every page before it (see flash_pages.py) up front."""
+    from concurrent.futures import ProcessPoolExecutor
+    from os import cpu_count, remove
+    from shutil import copyfileobj
+    from itertools import accumulate
+
+    check_complete(fn_bin)
+    workers = workers or cpu_count() or 1
+    skip = count_csv_rows(fn_csv) if append and exists(fn_csv) else 0
+    counts = page_sample_counts(fn_bin)
+    first_page, drop = resume_point(counts, skip)
+    counts = counts[first_page:]
+    shard_page_count = max(-(-len(counts)//workers), MIN_SHARD_PAGE_COUNT)
+    if workers <= 1 or len(counts) <= shard_page_count:
+        return bin2csv(fn_bin, fn_csv, config, append=append)
+    # number of (new) samples in the pages before each one
+    before = [0] + list(accumulate(counts))
+
+    logging.debug('Converting {} to {} in {} shard(s)...'.format(fn_bin, fn_csv, -(-len(counts)//shard_page_count)))
+    parts = []
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            F = []
+            for k in range(0, len(counts), shard_page_count):
+                parts.append('{}.part{}'.format(fn_csv, len(parts)))
+                F.append(pool.submit(convert_shard, fn_bin, parts[-1], config, first_page + k,
+                                     min(shard_page_count, len(counts) - k),
+                                     skip + max(before[k] - drop, 0), drop if 0 == k else 0))
+            for f in F:
+                f.result()
+
+        with open(fn_csv, 'a' if skip else 'w', newline='') as fout:
+            if not skip:
+                fout.write(','.join(CSV_HEADER) + '\r\n')
+            for fn in parts:
+                with open(fn, newline='') as fin:
+                    copyfileobj(fin, fout, 1024*1024)
+    finally:
+        for fn in parts:
+            if exists(fn):
+                remove(fn)
+
+def export_columnar(fn_bin, config):
+    """Write "[ID].columns" next to fn_bin if EXPORT_COLUMNAR is on and numpy is installed.
+    Return its name, or None if it wasn't written."""
+    if not EXPORT_COLUMNAR:
+        return None
+    try:
+        from columnar import bin2columns
+        import numpy
+    except ImportError:
+        logging.warning('numpy is not installed; no columnar file.')
+        return None
+    fn_columns = fn_bin.rsplit('.', 1)[0] + '.columns'
+    bin2columns(fn_bin, fn_columns, config)
+    return fn_columns
+
+def timestamp_strings(axis, first, count):
+    """(str(ts2dt(ts)), ts) of samples first, first + 1, ... (count of them) of TimeAxis axis, as
+    two lists."""
+    try:
+        import numpy as np
+    except ImportError:
+        ts = [axis.timestamp(k) for k in range(first, first + count)]
+        return [str(ts2dt(x)) for x in ts], ts
+    ts = axis.timestamps(slice(first, first + count))
+    t = ts2datetime64(ts)
+    dt = np.datetime_as_string(t, unit='us')
+    dt.view('U1').reshape(count, -1)[:, 10] = ' '       # 'T' to ' ', in place
+    # str(datetime) leaves out a zero microsecond
+    us = (t.astype(np.int64)%1000000).tolist()
+    dt = [x if u else x[:19] for x, u in zip(dt.tolist(), us)]
+    return dt, ts.tolist()
 
-            L = list(range(0, SPI_FLASH_PAGE_SIZE_BYTE, SAMPLE_SIZE_BYTE))
-            for a,b in list(zip(L[::], L[1::])):
-                d = struct.unpack('ffHHHHHH', page[a:b])
-                if any([math.isnan(dd) for dd in d]):
-                    break
-                D.append(d)
-
-    logging.debug('Reconstructing time axis...')
-    ts = construct_timestamp(config['logging_start_time'], len(D), SAMPLE_INTERVAL_CODE_MAP[config['logging_interval_code']])
-    dt = [ts2dt(tmp) for tmp in ts]
-    tmp = list(zip(*D))
-    tmp.insert(0, ts)
-    tmp.insert(0, dt)
-    D = zip(*tmp)
+def csv_block(D, config, first=0):
+    """The CSV rows of the decoded samples D, the first of which is sample number `first`, as
+    one string. Same as what csv.writer makes of them, a column at a time for the timestamps
+    and one % per row for the rest."""
+    if not len(D):
+        return ''
+    dt, ts = timestamp_strings(TimeAxis.from_config(config), first, len(D))
+    return ''.join([CSV_ROW % ((x, y) + d) for x, y, d in zip(dt, ts, D)])
 
+def write_csv(fn_csv, D, config, first=0, append=False):
+    """Write the decoded samples D (sample `first` onward) to fn_csv, timestamps and all.
+    If append is True, add them to the end of fn_csv (no header)."""
     logging.debug('Writing to {}...'.format(fn_csv))
-    with open(fn_csv, 'w', newline='') as fout:
-        writer = csv.writer(fout, delimiter=',')
-        fs = [str, str, lambda x: '{:.4f}'.format(x), lambda x: '{:.3f}'.format(x), str, str, str, str, str, str]
-        writer.writerow(['UTC_datetime', 'posix_timestamp', 'T_DegC', 'P_kPa', 'ambient_light_hdr', 'white_light_hdr', 'red', 'green', 'blue', 'white'])
-        for d in D:
-            #writer.writerow([str(x) for x in d])
-            writer.writerow([f(x) for f,x in zip(fs, d)])
+    with open(fn_csv, 'a' if append else 'w', newline='') as fout:
+        if not append:
+            fout.write(','.join(CSV_HEADER) + '\r\n')
+        fout.write(csv_block(D, config, first))
     
 
 if '__main__' == __name__:
@@ -116,7 +258,15 @@ if '__main__' == __name__:
     print('Data file: {}'.format(binfilename))
     print('Configuration file: {}'.format(configfilename))
     config = json.loads(open(configfilename).read())
+    try:
+        check_complete(binfilename)
+    except RuntimeError as e:
+        print('{} Terminating.'.format(e))
+        sys.exit()
 
-    bin2csv(binfilename, outputfilename, config)
+    bin2csv_sharded(binfilename, outputfilename, config)
+    columnsfilename = export_columnar(binfilename, config)
+    if columnsfilename is not None:
+        print('Columnar file: {}'.format(columnsfilename))
 
     print('Done.')
@@ -0,0 +1,142 @@
+# Convert every download under data/ (data/<flash_id>/*.bin, each with its .config) to CSV, and
+# to a columnar file if bin2csv.EXPORT_COLUMNAR is on, using all CPU cores.
+#
+# A .bin is skipped when its outputs are newer than it, its .config and its .manifest, or,
+# failing that (say the archive was copied and the times changed), when those hash to what they
+# were at the last conversion and the outputs are still what that conversion wrote. Those
+# records are kept in CACHE. Running this again on an archive that hasn't changed only looks at
+# file times. A download that was cut short (see download_manifest.py) is not converted.
+#
+# python bin2csv_batch.py [folder]      (default: data)
+#
+# MESHLAB, UH Manoa
+import time, logging, sys, json, hashlib
+from glob import glob
+from os import replace
+from os.path import join, exists, getmtime, getsize, relpath, basename
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from bin2csv import bin2csv, EXPORT_COLUMNAR, CONVERSION_WORKERS
+from download_manifest import manifest_name, is_incomplete
+
+
+logging.basicConfig(level=logging.WARNING)
+
+
+# what was converted from what, by content hash; kept in the data folder
+CACHE = 'bin2csv_cache.json'
+# convert everything, up to date or not
+FORCE = False
+
+
+def outputs(fn_bin, columnar=EXPORT_COLUMNAR):
+    """The files bin2csv.py makes out of fn_bin."""
+    base = fn_bin.rsplit('.', 1)[0]
+    L = [base + '.csv']
+    if columnar:
+        L.append(base + '.columns')
+    return L
+
+def file_hash(fn):
+    """None if there is no such file."""
+    if not exists(fn):
+        return None
+    h = hashlib.sha1()
+    with open(fn, 'rb') as fin:
+        for buf in iter(lambda: fin.read(1024*1024), b''):
+            h.update(buf)
+    return h.hexdigest()
+
+def load_cache(fn_cache):
+    try:
+        with open(fn_cache) as fin:
+            return json.load(fin)
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(fn_cache, cache):
+    # in one go, so that an interrupted run never leaves half a cache behind
+    with open(fn_cache + '.tmp', 'w') as fout:
+        json.dump(cache, fout, indent=2, sort_keys=True)
+    replace(fn_cache + '.tmp', fn_cache)
+
+def is_up_to_date(fn_bin, fn_config, record, columnar=EXPORT_COLUMNAR):
+    """True if the outputs of fn_bin don't need to be made again. record is what convert()
+    returned the last time (None if there is none)."""
+    L = outputs(fn_bin, columnar)
+    if not all(exists(fn) for fn in L):
+        return False
+    fn_manifest = manifest_name(fn_bin)
+    if min(getmtime(fn) for fn in L) >= max(getmtime(fn) for fn in [fn_bin, fn_config, fn_manifest] if exists(fn)):
+        return True
+    if record is None or record['outputs'] != {basename(fn): getsize(fn) for fn in L}:
+        return False
+    return record['bin'] == file_hash(fn_bin) and record['config'] == file_hash(fn_config) and \
+           record.get('manifest') == file_hash(fn_manifest)
+
+def convert(fn_bin, fn_config, columnar=EXPORT_COLUMNAR):
+    """Make the outputs of fn_bin. Return its cache record. Runs in a worker process."""
+    config = json.loads(open(fn_config).read())
+    # hashed before converting: if any of them changes halfway through, the record won't match it
+    record = {'bin': file_hash(fn_bin), 'config': file_hash(fn_config), 'manifest': file_hash(manifest_name(fn_bin))}
+    L = outputs(fn_bin, columnar)
+    bin2csv(fn_bin, L[0], config)
+    if columnar:
+        from columnar import bin2columns
+        bin2columns(fn_bin, L[1], config)
+    record['outputs'] = {basename(fn): getsize(fn) for fn in L}
+    return record
+
+def find_work(root):
+    """(fn_bin, fn_config) of every finished download under root."""
+    L = []
+    for fn_bin in sorted(glob(join(root, '*', '*.bin'))):
+        fn_config = fn_bin.rsplit('.', 1)[0] + '.config'
+        if not exists(fn_config):
+            logging.warning('{} has no .config. Skipped.'.format(fn_bin))
+            continue
+        # only what the manifest lists, not its CRCs: that would mean reading every .bin, every time
+        if is_incomplete(fn_bin, verify=False):
+            logging.warning('{} is an incomplete download (resume it with read_memory.py). Skipped.'.format(fn_bin))
+            continue
+        L.append((fn_bin, fn_config))
+    return L
+
+
+if '__main__' == __name__:
+
+    root = sys.argv[1] if len(sys.argv) > 1 else 'data'
+    fn_cache = join(root, CACHE)
+    columnar = EXPORT_COLUMNAR
+    if columnar:
+        try:
+            import numpy
+        except ImportError:
+            print('numpy is not installed; no columnar files.')
+            columnar = False
+
+    starttime = time.time()
+    cache = load_cache(fn_cache)
+    work = find_work(root)
+    # the cache is by path within root, so that it still works after the folder is moved
+    todo = [(fn_bin, fn_config) for fn_bin, fn_config in work
+            if FORCE or not is_up_to_date(fn_bin, fn_config, cache.get(relpath(fn_bin, root)), columnar)]
+    print('{} download(s) in {}, {} to convert.'.format(len(work), root, len(todo)))
+
+    failed = 0
+    if len(todo):
+        with ProcessPoolExecutor(max_workers=CONVERSION_WORKERS) as converters:
+            F = {converters.submit(convert, fn_bin, fn_config, columnar): fn_bin for fn_bin, fn_config in todo}
+            for f in as_completed(F):
+                fn_bin = F[f]
+                try:
+                    cache[relpath(fn_bin, root)] = f.result()
+                    print('Converted {}'.format(fn_bin))
+                except Exception:
+                    logging.exception(fn_bin)
+                    cache.pop(relpath(fn_bin, root), None)
+                    failed += 1
+    # forget what's no longer there
+    cache = {k: record for k, record in cache.items() if exists(join(root, k))}
+    save_cache(fn_cache, cache)
+
+    print('{} converted, {} failed. Took {:.1f} second(s).'.format(len(todo) - failed, failed, time.time() - starttime))
@@ -4,37 +4,94 @@
 # Stanley H.I. Lio
 # hlio@hawaii.edu
 # MESHLAB, UH Manoa
-import time, logging, sys, struct
+import time, logging, sys
 from serial import Serial
+from sparse_read import read_samples
 from common import get_logger_name, get_flash_id, read_vbatt, is_logging, get_logging_config,\
-     find_last_used_page, read_range_core, get_sample_count,\
-     SPI_FLASH_SIZE_BYTE, SPI_FLASH_PAGE_SIZE_BYTE, SAMPLE_SIZE_BYTE, SAMPLE_INTERVAL_CODE_MAP,\
-     InvalidResponseException
+     find_last_used_page, get_sample_count,\
+     SPI_FLASH_SIZE_BYTE, SAMPLE_INTERVAL_CODE_MAP,\
+     TimeAxis, InvalidResponseException
 from dev.set_rtc import read_rtc, ts2dt
-from datetime import datetime
 import matplotlib.pyplot as plt
 from matplotlib.dates import DateFormatter
 
 
 tags = ['UTC_datetime', 'T_DegC', 'P_kPa', 'ambient_light_hdr', 'white_light_hdr', 'red', 'green', 'blue', 'white']
-SAMPLE_PER_PAGE = SPI_FLASH_PAGE_SIZE_BYTE//SAMPLE_SIZE_BYTE
 
 
-# given a sample index, calculate (page address, byte index within that page)
-def sampleindex2flashaddress(sample_index):
-    return int(sample_index//SAMPLE_PER_PAGE), int((sample_index%SAMPLE_PER_PAGE)*SAMPLE_SIZE_BYTE)
+def make_figure():
+    """The overview figure, empty. Return (fig, ax, lines, caption)."""
+    fig, ax = plt.subplots(4, 1, figsize=(16, 9), sharex=True)
+    for tmp in ax[:-1]:
+        plt.setp(tmp.get_xticklabels(), visible=False)
+    ax[-1].set_xlabel('UTC Time')
 
-# given a sample index, time of the first sample, and the sample interval, calculate the sample index
-def date2sampleindex(t, logging_start_time, sample_interval_second):
-    ts = dt2ts(t) if type(t) is datetime else t
-    return (t - logging_start_time)//sample_interval_second
+    caption = plt.figtext(0.99, 0.01,
+                          '',
+                          horizontalalignment='right',
+                          color='k',
+                          alpha=0.5)
+
+    # column in tags: line
+    lines = {}
+    lines[1], = ax[0].plot_date([], [], 'r.:', label='Deg.C')
+    lines[2], = ax[1].plot_date([], [], '.:', label='kPa')
+    lines[3], = ax[2].plot_date([], [], '.:', label='als', alpha=0.5)
+    lines[4], = ax[2].plot_date([], [], '.:', label='white', alpha=0.5)
+    lines[5], = ax[3].plot_date([], [], 'r.:', label='r', alpha=0.5)
+    lines[6], = ax[3].plot_date([], [], 'g.:', label='g', alpha=0.5)
+    lines[7], = ax[3].plot_date([], [], 'b.:', label='b', alpha=0.5)
+    lines[8], = ax[3].plot_date([], [], 'k.:', label='w', alpha=0.2)
+    for tmp in ax:
+        tmp.legend(loc=2)
+        tmp.grid(True)
+
+    ax[-1].xaxis.set_major_formatter(DateFormatter('%b %d %H:%M:%S'))
+    plt.tight_layout()
+    fig.autofmt_xdate()
+    return fig, ax, lines, caption
+
+def update_figure(figure, D, stride, time_axis, logger_name, flash_id):
+    """Redraw the figure with what's in D ({sample index: sample}). stride is that of the latest
+    pass, time_axis the TimeAxis of all the samples in memory."""
+    fig, ax, lines, caption = figure
+    I = sorted(D)
+    t = time_axis.datetime64(I)
+    for k, line in lines.items():
+        line.set_data(t, [D[i][k - 1] for i in I])
+    for tmp in ax:
+        tmp.relim()
+        tmp.autoscale_view()
+
+    if stride > 1:
+        ax[0].set_title('Memory Overview (plotting one out of every {:,})'.format(stride))
+    else:
+        ax[0].set_title('Memory Overview (plotting everything)')
+
+    begin, end = ts2dt(time_axis.timestamp(I[0])), ts2dt(time_axis.timestamp(I[-1]))
+    s = 'Logger "{}" (ID={})'.format(logger_name, flash_id)
+    s += '\n{:,} samples from {} to {} spanning ~{:.1f} days'.format(len(time_axis),
+                                                                   begin.isoformat()[:19].replace('T', ' '),
+                                                                   end.isoformat()[:19].replace('T', ' '),
+                                                                   (end - begin).total_seconds()/3600/24)
+    if len(I) < len(time_axis):
+        s += ' (Plotting {} out of {})'.format(len(I), len(time_axis))
+    else:
+        s += ' (Plotting all samples)'
+    caption.set_text(s)
+    fig.canvas.draw_idle()
     
 
 if '__main__' == __name__:
     
     # Read this many samples from memory, evenly spaced.
     # If there aren't enough samples, read them all.
-    DOWNSAMPLE_N = 128
+    DOWNSAMPLE_N = 2048
+    # Show a coarse overview first (about FIRST_PASS_N samples), then refine it REFINE_FACTOR
+    # times over with every pass until DOWNSAMPLE_N, redrawing as it goes.
+    PROGRESSIVE = True
+    FIRST_PASS_N = 16
+    REFINE_FACTOR = 4
     USE_UTC = False
 
     # - - -
@@ -78,18 +135,25 @@ if '__main__' == __name__:
         print('Logger "{}" (ID={})'.format(logger_name, flash_id))
         print('Battery voltage {:.1f} V, clock {}'.format(vbatt, ts2dt(rtc)))
         print('Scanning logger memory...', end='', flush=True)
-        sample_count = get_sample_count(ser)
+        sample_count = get_sample_count(ser, config)
         if 0 == sample_count:
             print(' Logger is empty. Terminating.')
             sys.exit()
 
-        number_to_read = min(DOWNSAMPLE_N, sample_count)
-        STRIDE = int(sample_count // number_to_read)
-        m = '{} in steps of {}'.format(number_to_read, STRIDE) if STRIDE > 1 else 'everything'
-        print(' {} sample(s) in memory.\r\nRequested {} sample(s); will read {}.'.\
-              format(sample_count, DOWNSAMPLE_N, m))
+        print(' {} sample(s) in memory.'.format(sample_count))
+        time_axis = TimeAxis(logging_start_time, sample_interval_second, sample_count)
         print('First sample taken at {} UTC.'.format(ts2dt(logging_start_time)))
-        
+
+        # Strides of the passes, coarsest first. Each is a multiple of the next, so every pass
+        # only has to read the samples in between those it already has.
+        STRIDE = max(sample_count//DOWNSAMPLE_N, 1)
+        strides = [STRIDE]
+        while PROGRESSIVE and sample_count//strides[0] > FIRST_PASS_N:
+            strides.insert(0, strides[0]*REFINE_FACTOR)
+        m = 'in steps of {}'.format(STRIDE) if STRIDE > 1 else 'everything'
+        print('Requested {} sample(s); will read {} ({} pass(es)). Ctrl+C or close the plot to stop early.'.\
+              format(DOWNSAMPLE_N, m, len(strides)))
+
         # - - -
 
         #assert (0,0) == sampleindex2flashaddress(date2sampleindex(logging_start_time, logging_start_time, sample_interval_second))
@@ -99,98 +163,50 @@ if '__main__' == __name__:
         ser.reset_input_buffer()
         ser.reset_output_buffer()
 
-        D = []
-        current_page_index = None
-        current_page = None
-        sample_indices = list(range(0, sample_count, STRIDE))
-        addr = [sampleindex2flashaddress(i) for i in sample_indices]
-        print('Reading', end='', flush=True)
-        for sample_index, (page_i,byte_i) in zip(sample_indices, addr):
-            #print(sample_index, page_i, byte_i)
-            try:
-                if 0 == (sample_index//STRIDE) % (sample_count//STRIDE//10):
-                    print('.', end='', flush=True)
-
-                if current_page_index != page_i:
-                    logging.debug('Reading logger...')
-                    begin = page_i*SPI_FLASH_PAGE_SIZE_BYTE
-                    end = (page_i+1)*SPI_FLASH_PAGE_SIZE_BYTE - 1
-                    current_page = read_range_core(ser, begin, end)
-                    if len(current_page) != end - begin + 1:
-                        logging.warning('Invalid response length. Skipping sample {}'.format(sample_index))
-                        continue
-                    current_page_index = page_i
-                else:
-                    logging.debug('reuse')
-
-                d = struct.unpack('ffHHHHHH', current_page[byte_i : byte_i + SAMPLE_SIZE_BYTE])
-                D.append([sample_index, *d])
-            except KeyboardInterrupt:
-                print(' User interrupted. Proceed to plot.')
-                break
+        if PROGRESSIVE:
+            plt.ion()
+        D = {}
+        figure = None
+        closed = False
+        try:
+            for stride in strides:
+                sample_indices = [i for i in range(0, sample_count, stride) if i not in D]
+                print('Reading {} sample(s)'.format(len(sample_indices)), end='', flush=True)
+                # nearby samples are read together, far apart ones one at a time (see sparse_read.py)
+                for k, (sample_index, d) in enumerate(read_samples(ser, sample_indices)):
+                    if 0 == k % max(len(sample_indices)//10, 1):
+                        print('.', end='', flush=True)
+                    D[sample_index] = d
+                print()
+                if not PROGRESSIVE:
+                    continue
+                if figure is None:
+                    figure = make_figure()
+                elif not plt.fignum_exists(figure[0].number):
+                    closed = True
+                    break
+                update_figure(figure, D, stride, time_axis, logger_name, flash_id)
+                plt.pause(0.05)
+        except KeyboardInterrupt:
+            print(' User interrupted. Proceed to plot.')
 
     # - - -
     # Done with talking to the logger. Now plotting...
 
-    D = list(zip(*D))
-    assert len(D) == len(tags)
-    D[0] = [ts2dt(i*sample_interval_second + logging_start_time) for i in D[0]]
+    if closed:
+        print('Plot closed. Terminating.')
+        sys.exit()
+    if not len(D):
+        print('Nothing was read. Terminating.')
+        sys.exit()
 
-    print(' plotting... ', end='', flush=True)
-    
-    fig, ax = plt.subplots(4, 1, figsize=(16, 9), sharex=True)
-    for tmp in ax[:-1]:
-        plt.setp(tmp.get_xticklabels(), visible=False)
-    ax[-1].set_xlabel('UTC Time')
-
-    if STRIDE > 1:
-        ax[0].set_title('Memory Overview (plotting one out of every {:,})'.format(STRIDE, sample_count))
-    else:
-        ax[0].set_title('Memory Overview (plotting everything)')
-        
-    # add caption
-    s = 'Logger "{}" (ID={})'.format(logger_name, flash_id)
-    s += '\n{:,} samples from {} to {} spanning ~{:.1f} days'.format(sample_count,
-                                                                   min(D[0]).isoformat()[:19].replace('T', ' '),
-                                                                   max(D[0]).isoformat()[:19].replace('T', ' '),
-                                                                   (max(D[0]) - min(D[0])).total_seconds()/3600/24)
-
-    if STRIDE > 1:
-        s += ' (Plotting {} out of {})'.format(number_to_read, sample_count)
-    else:
-        s += ' (Plotting all samples)'.format(number_to_read, sample_count)
-    
-    plt.figtext(0.99, 0.01,
-                s,
-                horizontalalignment='right',
-                color='k',
-                alpha=0.5)
-
-    ax[0].plot_date(D[0], D[1], 'r.:', label='Deg.C')
-    ax[0].legend(loc=2)
-    ax[0].grid(True)
-
-    ax[1].plot_date(D[0], D[2], '.:', label='kPa')
-    ax[1].legend(loc=2)
-    ax[1].grid(True)
-
-    ax[2].plot_date(D[0], D[3], '.:', label='als', alpha=0.5)
-    ax[2].plot_date(D[0], D[4], '.:', label='white', alpha=0.5)
-    ax[2].legend(loc=2)
-    ax[2].grid(True)
-
-    ax[3].plot_date(D[0], D[5], 'r.:', label='r', alpha=0.5)
-    ax[3].plot_date(D[0], D[6], 'g.:', label='g', alpha=0.5)
-    ax[3].plot_date(D[0], D[7], 'b.:', label='b', alpha=0.5)
-    ax[3].plot_date(D[0], D[8], 'k.:', label='w', alpha=0.2)
-    ax[3].legend(loc=2)
-    ax[3].grid(True)
-
-    ax[-1].xaxis.set_major_formatter(DateFormatter('%b %d %H:%M:%S'))
-    plt.tight_layout()
-    plt.gcf().autofmt_xdate()
+    print('Plotting... ', end='', flush=True)
+    if figure is None or not plt.fignum_exists(figure[0].number):
+        figure = make_figure()
+    update_figure(figure, D, stride, time_axis, logger_name, flash_id)
 
     #print('Saving plot to disk...')
     #plt.savefig(fn.split('.')[0] + '.png', dpi=300)
     print('voila!')
+    plt.ioff()
     plt.show()
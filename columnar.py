@@ -0,0 +1,142 @@
+# Keep a deployment as columns of binary numbers instead of CSV text: one file per deployment,
+# T and P as float32, the light channels as uint16, the time axis as start + k*interval, and
+# the .config alongside. Loading one is a memory map, no parsing; each column is a numpy array
+# backed by the file.
+#
+#   bin2columns('data/E.../E..._1546300800.bin', 'data/E.../E..._1546300800.columns', config)
+#   columns, time_axis, config = load('data/E.../E..._1546300800.columns')
+#   columns['T_DegC'], time_axis.datetime64()
+#
+# bin2csv.py, read_memory.py and read_memory_batch.py write one next to the CSV when
+# bin2csv.EXPORT_COLUMNAR is on; plot_csv.py reads it instead of the CSV as long as it still
+# matches the .bin (see is_current()).
+#
+# File format: b'HLCO', a version byte, the length of the header (uint32, little-endian), the
+# header (JSON: sample count, logging_start_time, sample interval, the .config, size and SHA-1
+# of the .bin it was made from, and name, dtype and byte offset of every column), then the
+# columns one after the other, each starting on a multiple of ALIGNMENT bytes. Needs numpy
+# (except for read_header() and is_current()).
+#
+# MESHLAB, UH Manoa
+import json, struct, logging, mmap, hashlib
+from os.path import exists, getsize
+from common import TimeAxis, SPI_FLASH_PAGE_SIZE_BYTE
+from flash_pages import count_samples
+from sample_codec import FIELDS, sample_dtype, decode
+from download_manifest import check_complete
+
+
+MAGIC = b'HLCO'
+VERSION = 1
+HEADER_LENGTH = struct.Struct('<I')
+ALIGNMENT = 64
+# convert this many pages at a time
+BATCH_PAGE_COUNT = 4096
+
+
+def _align(n):
+    return -(-n//ALIGNMENT)*ALIGNMENT
+
+def _sha1(buf):
+    h = hashlib.sha1()
+    h.update(buf)
+    return h.hexdigest()
+
+def bin2columns(fn_bin, fn_columns, config, batch_page_count=BATCH_PAGE_COUNT):
+    """Convert a .bin to a columnar file, batch_page_count pages at a time. config is the
+    content of the .config. Return the number of samples. An incomplete download is refused
+    (RuntimeError)."""
+    import numpy as np
+    check_complete(fn_bin)
+    with open(fn_bin, 'rb') as fin:
+        try:
+            buf = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            buf = b''       # empty file
+        try:
+            count = count_samples(buf)
+            time_axis = TimeAxis.from_config(config, count)
+            dtype = sample_dtype()
+            header = {'count': count,
+                      'logging_start_time': time_axis.start,
+                      'interval_second': time_axis.interval,
+                      'config': config,
+                      # what it was made from, to tell whether it still matches (see is_current())
+                      'source': {'size': len(buf), 'sha1': _sha1(buf)},
+                      'columns': []}
+            # the header's length depends on the offsets and the offsets on the header's length
+            offset = 0
+            while True:
+                header['columns'] = []
+                o = offset
+                for f in FIELDS:
+                    header['columns'].append({'name': f, 'dtype': dtype[f].str, 'offset': o})
+                    o = _align(o + count*dtype[f].itemsize)
+                h = json.dumps(header).encode()
+                start = _align(len(MAGIC) + 1 + HEADER_LENGTH.size + len(h))
+                if start == offset:
+                    break
+                offset = start
+            size = o
+
+            logging.debug('{} sample(s) from {} into {}'.format(count, fn_bin, fn_columns))
+            with open(fn_columns, 'wb') as fout:
+                fout.write(MAGIC + bytes([VERSION]) + HEADER_LENGTH.pack(len(h)) + h)
+                fout.truncate(size)
+            if count:
+                out = np.memmap(fn_columns, dtype='u1', mode='r+', shape=(size,))
+                columns = {c['name']: out[c['offset']:c['offset'] + count*dtype[c['name']].itemsize].view(c['dtype'])
+                           for c in header['columns']}
+                k = 0
+                page_count = len(buf)//SPI_FLASH_PAGE_SIZE_BYTE
+                for first in range(0, page_count, batch_page_count):
+                    a = decode(buf, first, min(batch_page_count, page_count - first))
+                    for f in FIELDS:
+                        columns[f][k:k + len(a)] = a[f]
+                    k += len(a)
+                assert k == count
+                out.flush()
+                del columns, out, a
+        finally:
+            if isinstance(buf, mmap.mmap):
+                buf.close()
+    return count
+
+def read_header(fn_columns):
+    with open(fn_columns, 'rb') as fin:
+        magic = fin.read(len(MAGIC) + 1)
+        if not magic.startswith(MAGIC) or VERSION != magic[-1]:
+            raise ValueError('{} is not a columnar file (or is from a different version)'.format(fn_columns))
+        n, = HEADER_LENGTH.unpack(fin.read(HEADER_LENGTH.size))
+        return json.loads(fin.read(n).decode())
+
+def is_current(fn_columns, fn_bin):
+    """True if fn_columns was made from fn_bin as it is now (same size and content). False if
+    either is missing, or if fn_columns predates the record of its source."""
+    if not exists(fn_columns) or not exists(fn_bin):
+        return False
+    try:
+        source = read_header(fn_columns).get('source')
+    except ValueError:
+        return False
+    if source is None or source['size'] != getsize(fn_bin):
+        return False
+    with open(fn_bin, 'rb') as fin:
+        return source['sha1'] == _sha1(fin.read())
+
+def load(fn_columns, mmap_mode='r'):
+    """Return (columns, time axis, config) of a columnar file. columns is {name: numpy array},
+    in the order of sample_codec.FIELDS, memory-mapped from the file (mmap_mode as in
+    numpy.memmap; None to read them into memory instead)."""
+    import numpy as np
+    header = read_header(fn_columns)
+    count = header['count']
+    columns = {}
+    for c in header['columns']:
+        if mmap_mode is None or 0 == count:
+            with open(fn_columns, 'rb') as fin:
+                fin.seek(c['offset'])
+                columns[c['name']] = np.fromfile(fin, dtype=c['dtype'], count=count)
+        else:
+            columns[c['name']] = np.memmap(fn_columns, dtype=c['dtype'], mode=mmap_mode, offset=c['offset'], shape=(count,))
+    return columns, TimeAxis(header['logging_start_time'], header['interval_second'], count), header['config']
@@ -13,8 +13,10 @@
 # Stanley H.I. Lio
 # hlio@hawaii.edu
 # MESHLAB, UH Manoa
-import logging, random, time, string, calendar
-from dev.crc_check import check_response
+import logging, random, time, string, calendar, math
+from collections import deque
+from dev.crc_check import check_response, check_crc
+from link_metrics import METRICS
 from datetime import datetime
 
 
@@ -23,14 +25,128 @@ SAMPLE_INTERVAL_CODE_MAP = {0:1/5, 1:1, 2:60}
 SPI_FLASH_SIZE_BYTE = 16*1024*1024
 SPI_FLASH_PAGE_SIZE_BYTE = 256
 SAMPLE_SIZE_BYTE = 20    # size of one sample in byte
+SAMPLE_PER_PAGE = SPI_FLASH_PAGE_SIZE_BYTE//SAMPLE_SIZE_BYTE     # the last 16 bytes of a page are never used
 # retry at most this many times on comm error
 MAX_RETRY = 16
+# keep at most this many flash read requests outstanding (the firmware's command buffer is small)
+PIPELINE_WINDOW = 4
+# length of the read that checks the link is back in step after a resync. Not a multiple of a
+# sample or a page, so that no other response can pass for its answer.
+PROBE_SIZE_BYTE = 13
 
 
 class InvalidResponseException(Exception):
     pass
 
 
+class RetryPolicy:
+    """How hard to try before giving up on a command.
+
+    Every command helper below retries through attempts(). Between attempts it waits an
+    exponentially growing, randomly jittered delay (backoff, 2*backoff, 4*backoff... capped at
+    backoff_max; full jitter so that loggers sharing a hub don't retry in lockstep). It gives up
+    after maxretry attempts (unless the helper is given a maxretry of its own), once `deadline`
+    seconds have passed, or as soon as `dead_after` attempts in a row got no response at all,
+    which is what a port without a logger on it looks like.
+
+    `settle` is a fixed wait, on top of any jitter, wherever the logger must be given time to
+    act on a command or to finish sending a bad response before its input is thrown away.
+
+    The duration of every attempt is kept in `latencies` (command: recent attempts, in seconds)
+    for tuning; see summary().
+    """
+    def __init__(self, maxretry=10, deadline=10, backoff=0.05, backoff_max=0.8, dead_after=3, settle=0.1, history=1000):
+        self.maxretry = maxretry
+        self.deadline = deadline
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.dead_after = dead_after
+        self.settle = settle
+        self.history = history
+        self.latencies = {}
+        self.retries = {}
+
+    def delay(self, i):
+        """The (random) wait before retry i, i >= 1."""
+        return random.uniform(0, min(self.backoff*2**(i - 1), self.backoff_max))
+
+    def count_retry(self, name, n=1):
+        self.retries[name] = self.retries.get(name, 0) + n
+        METRICS.count(name, 'retries', n)
+
+    def retrying(self, name, i, starttime, deadline):
+        """Count retry i of command `name` (first tried at starttime). Return how long to wait
+        before it, or None if that would go past the deadline."""
+        logging.debug('{}(): retrying...'.format(name))
+        self.count_retry(name)
+        delay = self.delay(i)
+        if time.time() + delay - starttime > deadline:
+            logging.debug('{}(): deadline reached'.format(name))
+            return None
+        return delay
+
+    def attempts(self, name, maxretry=None, deadline=None):
+        """Yield one Attempt per try at command `name`. Call its got() with whatever came back."""
+        maxretry = self.maxretry if maxretry is None else maxretry
+        deadline = self.deadline if deadline is None else deadline
+        starttime = time.time()
+        silent = 0
+        for i in range(maxretry):
+            if i > 0:
+                delay = self.retrying(name, i, starttime, deadline)
+                if delay is None:
+                    return
+                time.sleep(delay)
+            attempt = Attempt(self, name)
+            yield attempt
+            silent = silent + 1 if attempt.silent else 0
+            if self.dead_after and silent >= self.dead_after:
+                logging.debug('{}(): no response at all. Giving up.'.format(name))
+                return
+
+    def record(self, name, latency):
+        self.latencies.setdefault(name, deque(maxlen=self.history)).append(latency)
+
+    def summary(self):
+        """{command: {'attempts', 'retries', 'median', 'max'}}, latencies in seconds."""
+        r = {}
+        for name, L in self.latencies.items():
+            L = sorted(L)
+            r[name] = {'attempts': len(L),
+                       'retries': self.retries.get(name, 0),
+                       'median': L[len(L)//2],
+                       'max': L[-1],
+                       }
+        return r
+
+
+class Attempt:
+    def __init__(self, policy, name):
+        self.policy = policy
+        self.name = name
+        self.starttime = time.time()
+        self.silent = False
+
+    def send(self, ser, cmd):
+        """Write the command for this attempt. Latency counts from here."""
+        self.starttime = time.time()
+        METRICS.count(self.name, 'bytes_sent', len(cmd))
+        return ser.write(cmd)
+
+    def got(self, r):
+        """Record the response (bytes) to this attempt. Return it, for convenience."""
+        latency = time.time() - self.starttime
+        self.policy.record(self.name, latency)
+        METRICS.exchange(self.name, latency, len(r))
+        self.silent = len(r) <= 0
+        if self.silent:
+            METRICS.count(self.name, 'timeouts')
+        return r
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
 def dt2ts(dt=None):
     if dt is None:
         dt = datetime.utcnow()
@@ -41,63 +157,188 @@ def ts2dt(ts=None):
         ts = dt2ts()
     return datetime.utcfromtimestamp(ts)
 
-
-def is_logging(ser, maxretry=10):
-    logging.debug('is_logging()')
+# given a sample index, calculate (page address, byte index within that page)
+def sampleindex2flashaddress(sample_index):
+    return int(sample_index//SAMPLE_PER_PAGE), int((sample_index%SAMPLE_PER_PAGE)*SAMPLE_SIZE_BYTE)
+
+# given a time (datetime or POSIX timestamp), time of the first sample, and the sample interval,
+# calculate the index of the sample taken at or just before that time
+def date2sampleindex(t, logging_start_time, sample_interval_second):
+    ts = dt2ts(t) if isinstance(t, datetime) else t
+    # not //: 0.6//0.2 is 2.0
+    return math.floor(round((ts - logging_start_time)/sample_interval_second, 6))
+
+def ts2datetime64(ts):
+    """numpy datetime64[us] array of the POSIX timestamps ts, in one go. Same as ts2dt() on each:
+    the fraction of a second is rounded (half to even) to the nearest microsecond."""
+    import numpy as np
+    ts = np.asarray(ts, dtype=np.float64)
+    sec = np.floor(ts)
+    us = np.round((ts - sec)*1e6).astype(np.int64)
+    return (sec.astype(np.int64)*1000000 + us).astype('datetime64[us]')
+
+
+class TimeAxis:
+    """The logger's sample clock: sample k is taken at start + k*interval (POSIX timestamp), for
+    k in [0, count). Kept as those three numbers; timestamps and datetimes are only made when
+    asked for, all at once, as numpy arrays (timestamp() and index() do one sample and don't
+    need numpy).
+
+    index in timestamps()/datetime64() is None (all count of them), a slice, or any sequence of
+    sample indices."""
+    def __init__(self, start, interval, count=0):
+        self.start = start
+        self.interval = interval
+        self.count = count
+
+    @classmethod
+    def from_config(cls, config, count=0):
+        return cls(config['logging_start_time'], SAMPLE_INTERVAL_CODE_MAP[config['logging_interval_code']], count)
+
+    def __len__(self):
+        return self.count
+
+    def timestamp(self, k):
+        return k*self.interval + self.start
+
+    def index(self, t):
+        """Index of the sample taken at or just before t (datetime or POSIX timestamp). Not
+        limited to [0, count)."""
+        return date2sampleindex(t, self.start, self.interval)
+
+    def window(self, begin, end):
+        """(first, last) index of the samples taken within [begin, end] (datetime or POSIX
+        timestamp), or None if there is none in [0, count)."""
+        begin = dt2ts(begin) if isinstance(begin, datetime) else begin
+        first = self.index(begin)
+        if self.timestamp(first) < begin:
+            first += 1
+        first = max(first, 0)
+        last = min(self.index(end), self.count - 1)
+        if first > last:
+            return None
+        return first, last
+
+    def indices(self, index=None):
+        import numpy as np
+        if index is None:
+            index = slice(0, self.count)
+        if isinstance(index, slice):
+            return np.arange(index.start or 0, self.count if index.stop is None else index.stop, index.step or 1)
+        return np.asarray(index)
+
+    def timestamps(self, index=None):
+        return self.indices(index)*self.interval + self.start
+
+    def datetime64(self, index=None):
+        return ts2datetime64(self.timestamps(index))
+
+
+def reset_buffers(ser):
     ser.flushInput()
     ser.flushOutput()
     ser.reset_input_buffer()
     ser.reset_output_buffer()
 
-    for i in range(maxretry):
-        try:
-            if i > 0:
-                logging.debug('is_logging(): retrying...')
-            ser.write(b'is_logging')
-            #ser.reset_output_buffer()
-            r = ser.readline()
-            logging.debug(r)
-            r = r.decode().strip().split(',')
-            if len(r) == 3 and r[0] in ['0', '1']:
-                return '1' == r[0]
-        except (UnicodeDecodeError, IndexError, TypeError, ValueError):
-            logging.debug(r)
-        time.sleep(random.randint(0, 90)/100)
 
+# Parsers of the responses to the simple commands, shared with common_async.py. Each takes the
+# response line (bytes) and returns what it means, or raises ValueError if it doesn't make sense.
+
+LOGGING_CONFIG_TAGS = ['logging_start_time', 'logging_stop_time', 'logging_interval_code', 'current_page_addr', 'byte_index_within_page']
+
+def parse_is_logging(r):
+    r = r.decode().strip().split(',')
+    if len(r) == 3 and r[0] in ['0', '1']:
+        return '1' == r[0]
+    raise ValueError(r)
+
+def parse_logging_config(r):
+    r = [int(tmp) for tmp in r.decode().strip().split(',')]
+    if len(r) >= 3:  # ... isn't there any simple self-descriptive format? or an ultra-intelligent parser?
+        return dict(zip(LOGGING_CONFIG_TAGS, r))
+    raise ValueError(r)
+
+def parse_vbatt(r):
+    r = r.decode().strip().split(',')
+    if len(r) < 2:
+        raise ValueError(r)
+    return round(float(r[1]), 2)
+
+def parse_logger_name(r):
+    # there's no easy way to tell whether the name is not set, the logger is not responding, or those gibberish characters really is the name
+    # without proper framing and checksum in storage and in comm, any check you do here is just heuristics/guess/hack
+    # hindsight 20/20
+
+    # what about an empty string as name? You'd get no response (or all \x00 in the next version of firmware)
+    if all([0xff == c for c in r[:-1]]):
+        # name is not set
+        logging.debug('name has not been set')
+        return ''
+    r = r.decode().strip()      # can't be decoded: the name is probably not set
+    if len(r) <= 0:
+        logging.debug('No response...')
+        raise ValueError(r)
+    return r
+
+def parse_rtc(r):
+    return float(r.decode().strip())
+
+def parse_flash_id(r):
+    r = r.decode().strip()
+    if 16 == len(r) and r.startswith('E') and all([c in string.hexdigits for c in r]):
+        return r
+    raise ValueError(r)
+
+def range_command(begin, end):
+    """The command to read flash [begin, end]. Its response is end - begin + 1 bytes plus a CRC32."""
+    assert end >= begin
+    return 'spi_flash_read_range{:x},{:x}\n'.format(begin, end).encode()
+
+def command(ser, name, cmd, parse, maxretry=None, policy=None):
+    """Send cmd until parse() makes sense of the response line. Return what it made of it."""
+    policy = DEFAULT_RETRY_POLICY if policy is None else policy
+    for attempt in policy.attempts(name, maxretry):
+        attempt.send(ser, cmd)
+        r = attempt.got(ser.readline())
+        logging.debug(r)
+        try:
+            return parse(r)
+        except ValueError:      # UnicodeDecodeError included
+            logging.debug('{}(): invalid response {}'.format(name, r))
     raise InvalidResponseException('Invalid/no response from logger')
 
 
-def stop_logging(ser, maxretry=10):
-    logging.debug('stop_logging()')
-    ser.flushInput()
-    ser.flushOutput()
-    ser.reset_input_buffer()
-    ser.reset_output_buffer()
+def is_logging(ser, maxretry=None, reset=True, policy=None):
+    logging.debug('is_logging()')
+    if reset:
+        reset_buffers(ser)
+    return command(ser, 'is_logging', b'is_logging', parse_is_logging, maxretry, policy)
 
-    stopped = False
-    for i in range(maxretry):
-        if i > 0:
-            logging.debug('stop_logging(): retrying...')
-        ser.write(b'stop_logging')
-        time.sleep(random.randint(0, 90)/100)
-        
-        if not is_logging(ser):
-            stopped = True
-            break
+def stop_logging(ser, maxretry=None, reset=True, policy=None):
+    logging.debug('stop_logging()')
+    policy = DEFAULT_RETRY_POLICY if policy is None else policy
+    if reset:
+        reset_buffers(ser)
 
-    return stopped
+    for attempt in policy.attempts('stop_logging', maxretry, deadline=float('inf')):
+        # no response to this one as such; is_logging() tells whether it took, once it has had time to
+        attempt.send(ser, b'stop_logging')
+        time.sleep(policy.settle)
+        if not is_logging(ser, policy=policy):
+            return True
 
+    return False
 
-def probably_empty(ser, maxretry=5):
+def probably_empty(ser, maxretry=5, policy=None):
+    # flash_pages.py imports this module, hence not at the top
+    from flash_pages import is_erased
     logging.debug('probably_empty()')
-    ser.flushInput()
-    ser.flushOutput()
-    ser.reset_input_buffer()
-    ser.reset_output_buffer()
+    policy = DEFAULT_RETRY_POLICY if policy is None else policy
+    reset_buffers(ser)
 
-    for i in range(maxretry):
-        ser.write(b'is_logging')
-        line = ser.readline().decode().strip()
+    for attempt in policy.attempts('probably_empty', maxretry):
+        attempt.send(ser, b'is_logging')
+        line = attempt.got(ser.readline()).decode().strip()
         try:
             r = line.split(',')
             if 3 != len(r):
@@ -110,11 +351,11 @@ def probably_empty(ser, maxretry=5):
         except IndexError:
             raise InvalidResponseException('Invalid/no response from logger: ' + line)
     
-    for i in range(maxretry):
-        ser.write(b'spi_flash_read_range0,ff\n')
-        r = ser.readline()
+    for attempt in policy.attempts('probably_empty_read', maxretry):
+        attempt.send(ser, b'spi_flash_read_range0,ff\n')
+        r = attempt.got(ser.readline())
         if 256+4 == len(r):
-            if all([0xFF == rr for rr in r[:-4]]):
+            if is_erased(r[:-4]):
                 #ser.reset_input_buffer()
                 ser.readline()
                 return True
@@ -130,101 +371,37 @@ def probably_empty(ser, maxretry=5):
     ser.readline()
     return False
 
-
-def get_logging_config(ser, maxretry=10):
+def get_logging_config(ser, maxretry=None, policy=None):
     logging.debug('get_logging_config()')
-    tags = ['logging_start_time', 'logging_stop_time', 'logging_interval_code', 'current_page_addr', 'byte_index_within_page']
-    
-    for i in range(maxretry):
-        ser.write(b'get_logging_config')
-        try:
-            r = ser.readline()
-            logging.debug(r)
-            if len(r):
-                r = r.decode().strip().split(',')
-            if len(r):
-                r = [int(tmp) for tmp in r]
-                if len(r) >= 3:  # ... isn't there any simple self-descriptive format? or an ultra-intelligent parser?
-                    return dict(zip(tags, r))
-        except:
-            logging.exception(r)
-        time.sleep(random.randint(0, 50)/100)
-    raise InvalidResponseException('Invalid/no response from logger')
-
+    return command(ser, 'get_logging_config', b'get_logging_config', parse_logging_config, maxretry, policy)
 
-def read_vbatt(ser, maxretry=10):
+def read_vbatt(ser, maxretry=None, policy=None):
     logging.debug('read_vbatt()')
-    
-    for i in range(maxretry):
-        try:
-            ser.write(b'read_sys_volt')
-            r = ser.readline().decode().strip().split(',')
-            logging.debug(r)
-            return round(float(r[1]), 2)
-        except (UnicodeDecodeError, ValueError, IndexError):
-            logging.exception('')
-    raise InvalidResponseException('Invalid/no response from logger')
-
+    return command(ser, 'read_sys_volt', b'read_sys_volt', parse_vbatt, maxretry, policy)
 
-def get_logger_name(ser, maxretry=10):
+def get_logger_name(ser, maxretry=None, reset=True, policy=None):
     logging.debug('get_logger_name()')
-    ser.flushInput()
-    ser.flushOutput()
-    ser.reset_input_buffer()
-    ser.reset_output_buffer()
-
-    # there's no easy way to tell whether the name is not set, the logger is not responding, or those gibberish characters really is the name
-    # without proper framing and checksum in storage and in comm, any check you do here is just heuristics/guess/hack
-    # hindsight 20/20
-
-    for i in range(maxretry):
-        ser.write(b'get_logger_name')
-        try:
-            r = ser.readline()
-            # what about an empty string as name? You'd get no response (or all \x00 in the next version of firmware)
-            if all(['\xff' == c for c in r[:-1]]):
-                # name is not set
-                logging.debug('name has not been set')
-                return ''
-            r = r.decode().strip()
-            logging.debug(r)
-            if len(r) <= 0:
-                logging.debug('No response...')
-                time.sleep(random.randint(0, 200)/1000)
-                continue
-            return r
-        except UnicodeDecodeError:      # the name is probably not set
-            time.sleep(random.randint(0, 200)/1000)
-            continue
-    #raise InvalidResponseException('Invalid/no response from logger')
-    return ''
-
+    if reset:
+        reset_buffers(ser)
+    try:
+        return command(ser, 'get_logger_name', b'get_logger_name', parse_logger_name, maxretry, policy)
+    except InvalidResponseException:
+        return ''
 
-def get_flash_id(ser, maxretry=10):
+def get_flash_id(ser, maxretry=None, reset=True, policy=None):
     logging.debug('get_flash_id()')
-    ser.flushInput()
-    ser.flushOutput()
-    ser.reset_input_buffer()
-    ser.reset_output_buffer()
-
-    for i in range(maxretry):
-        ser.write(b'spi_flash_get_unique_id')
-        try:
-            r = ser.readline().decode().strip()
-            if len(r) <= 0:
-                continue
-            logging.debug(r)
-            if 16 == len(r) and r.startswith('E') and all([c in string.hexdigits for c in r]):
-                #ser.reset_input_buffer()
-                #ser.readline()
-                return r
-        except UnicodeDecodeError:
-            pass
-        time.sleep(random.randint(0, 50)/100)
-    raise InvalidResponseException('Invalid/no response from logger: ' + r)
-
-
-def get_metadata(ser, maxretry=10):
+    if reset:
+        reset_buffers(ser)
+    return command(ser, 'get_flash_id', b'spi_flash_get_unique_id', parse_flash_id, maxretry, policy)
+
+def read_rtc(ser, maxretry=None, reset=True, policy=None):
+    """The logger's clock, as a POSIX timestamp."""
+    logging.debug('read_rtc()')
+    if reset:
+        reset_buffers(ser)
+    return command(ser, 'read_rtc', b'read_rtc', parse_rtc, maxretry, policy)
+
+def get_metadata(ser, maxretry=None):
     flash_id = get_flash_id(ser, maxretry)
     logger_name = get_logger_name(ser, maxretry)
     running = is_logging(ser)
@@ -240,46 +417,401 @@ def get_metadata(ser, maxretry=10):
 
     return config
 
-def read_range_core(ser, begin, end):
-    assert end >= begin
+class LoggerSession:
+    """Talk to one logger through `ser`, remembering what doesn't change between commands.
+    The flash ID is read once. The name, and the logging config of a logger that is not logging,
+    are kept until a command that changes them goes out through this session (see send()).
+    Buffers are only reset before an exchange if the previous one failed or left bytes behind.
+    """
+    # command prefix: cached facts it invalidates
+    MUTATING = {b'set_logger_name': ['logger_name'],
+                b'clear_memory': ['logging_config'],
+                b'start_logging': ['is_logging', 'logging_config'],
+                b'stop_logging': ['is_logging', 'logging_config'],
+                b'set_logging_interval': ['logging_config'],
+                }
+
+    def __init__(self, ser):
+        self.ser = ser
+        self.cache = {}
+        self.dirty = True
+
+    def exchange(self, f, *args, **kwargs):
+        """Call f(ser, *args, reset=..., **kwargs), keeping track of whether the link is in a clean state."""
+        try:
+            r = f(self.ser, *args, reset=self.dirty, **kwargs)
+        except:
+            self.dirty = True
+            raise
+        # anything still coming in is left over from a retry, or an answer to someone else
+        self.dirty = self.ser.in_waiting > 0
+        return r
+
+    def cached(self, key, f, *args, **kwargs):
+        if key not in self.cache:
+            self.cache[key] = self.exchange(f, *args, **kwargs)
+        return self.cache[key]
+
+    def invalidate(self, *keys):
+        """Forget the given facts (all if none given)."""
+        for k in keys if len(keys) else list(self.cache):
+            self.cache.pop(k, None)
+
+    def send(self, cmd):
+        """Send a command that changes the logger's state (e.g. b'start_logging'). Invalidate whatever it changes."""
+        for prefix, keys in self.MUTATING.items():
+            if cmd.startswith(prefix):
+                self.invalidate(*keys)
+        self.ser.write(cmd)
+        # its response, if any, is not ours to read
+        self.dirty = True
+
+    def get_flash_id(self, maxretry=None):
+        return self.cached('flash_id', get_flash_id, maxretry)
+
+    def get_logger_name(self, maxretry=None):
+        return self.cached('logger_name', get_logger_name, maxretry)
+
+    def is_logging(self, maxretry=None):
+        # A logger that isn't logging stays that way until told otherwise. One that is logging
+        # may stop on its own (full memory, flat battery), so that is never taken for granted.
+        if 'is_logging' not in self.cache:
+            running = self.exchange(is_logging, maxretry)
+            if running:
+                return True
+            self.cache['is_logging'] = False
+        return self.cache['is_logging']
+
+    def get_logging_config(self, maxretry=None):
+        # the memory pointers move while it's logging, so it is only kept once the logger is
+        # known not to be (this doesn't ask; see is_logging())
+        if self.cache.get('is_logging', True):
+            self.invalidate('logging_config')
+        return self.cached('logging_config', lambda ser, maxretry, reset: get_logging_config(ser, maxretry), maxretry)
+
+    def read_vbatt(self, maxretry=None):
+        return self.exchange(lambda ser, maxretry, reset: read_vbatt(ser, maxretry), maxretry)
+
+    def read_rtc(self, maxretry=None):
+        return self.exchange(read_rtc, maxretry)
 
-    cmd = 'spi_flash_read_range{:x},{:x}\n'.format(begin, end)
+    def stop_logging(self, maxretry=None):
+        self.invalidate(*self.MUTATING[b'stop_logging'])
+        stopped = self.exchange(stop_logging, maxretry)
+        if stopped:
+            # it has just said so
+            self.cache['is_logging'] = False
+        return stopped
 
-    for retry in range(MAX_RETRY):
+    def set_logger_name(self, name):
+        self.send('set_logger_name{}\n'.format(name).encode())
+
+    def get_metadata(self, maxretry=None):
+        running = self.is_logging(maxretry)
+        metadata = self.get_logging_config(maxretry)
+
+        config = {}
+        config['flash_id'] = self.get_flash_id(maxretry)
+        config['logger_name'] = self.get_logger_name(maxretry)
+        config['is_logging'] = running
+        config['logging_start_time'] = metadata['logging_start_time']
+        config['logging_stop_time'] = metadata['logging_stop_time']
+        config['logging_interval_code'] = metadata['logging_interval_code']
+        return config
+
+def read_range_core(ser, begin, end, policy=None):
+    policy = DEFAULT_RETRY_POLICY if policy is None else policy
+    cmd = range_command(begin, end)
+
+    # no deadline: a big range takes a while to come through at 115200 baud
+    for attempt in policy.attempts('spi_flash_read_range', MAX_RETRY, deadline=float('inf')):
         ser.reset_input_buffer()
         ser.reset_output_buffer()
         
         #logging.debug(cmd.strip())
         #logging.debug('Reading {:X} to {:X} ({:.2f}%)'.format(begin, end, end/SPI_FLASH_SIZE_BYTE*100))
-        ser.write(cmd.encode())
+        attempt.send(ser, cmd)
         expected_length = end - begin + 1 + 4
-        line = ser.read(expected_length)
+        line = attempt.got(ser.read(expected_length))
         if len(line) != expected_length:
-            time.sleep(0.1)
+            time.sleep(policy.settle)
             logging.warning('Response length mismatch. Expected {} bytes, got {} bytes'.format(expected_length, len(line)))
+            if len(line):
+                METRICS.count('spi_flash_read_range', 'short_reads')
             continue
         if not check_response(line):
-            time.sleep(0.1)
+            time.sleep(policy.settle)
             logging.warning('CRC failure')
+            METRICS.count('spi_flash_read_range', 'crc_failures')
             continue
         
         return line[:-4]    # strip CRC32
     return bytearray()
 
+def in_step(ser, begin, known=None, maxretry=MAX_RETRY, policy=None):
+    """Read PROBE_SIZE_BYTE bytes from `begin` and check that what comes back is that and only
+    that: right length, good CRC, equal to `known` (bytes already verified at that address) if
+    given, and nothing else behind it. Return False if it still isn't after maxretry tries."""
+    policy = DEFAULT_RETRY_POLICY if policy is None else policy
+    cmd = range_command(begin, begin + PROBE_SIZE_BYTE - 1)
+    for attempt in policy.attempts('spi_flash_read_range_probe', maxretry, deadline=float('inf')):
+        attempt.send(ser, cmd)
+        line = attempt.got(ser.read(PROBE_SIZE_BYTE + 4))
+        if len(line) == PROBE_SIZE_BYTE + 4 and check_response(line) and \
+           (known is None or line[:-4] == known) and ser.in_waiting <= 0:
+            return True
+        time.sleep(policy.settle)
+        ser.reset_input_buffer()
+    return False
+
+def read_range_pipelined(ser, ranges, window=PIPELINE_WINDOW, maxretry=MAX_RETRY, feedback=None, into=None, policy=None):
+    """Read a sequence of (begin, end) byte ranges, keeping up to `window` requests in flight.
+    Yield (begin, end, data) in the same order as `ranges`. data is the response with the
+    CRC32 stripped, or an empty bytearray if the range still fails after `maxretry` attempts
+    (same convention as read_range_core()).
+
+    If into(begin, end) is given, it must return a writable buffer of end - begin + 1 bytes;
+    the response is read straight into it (CRC checked in place) and data is that buffer.
+
+    The firmware answers requests strictly in order, so the n-th response belongs to the n-th
+    outstanding request. A response of the right length but bad CRC only costs that one range;
+    a short response (or two bad ones in a row) means the stream is out of step, so everything
+    in flight is re-issued, but only once in_step() has re-read some bytes that were already
+    verified and got them back unchanged: a stale response that happens to pass its CRC must
+    not be taken for the answer to a different range of the same size. If in_step() gives up
+    (see `policy`), InvalidResponseException is raised; nothing more is read over that link.
+    `ranges` is consumed lazily, so it can be a generator whose next range depends on how the
+    previous ones went. If given, feedback(begin, end, ok) is called after every response. If,
+    for a failed range, it returns a list of (begin, end), those are read (and yielded) in its
+    place; AdaptiveChunkSize uses this to re-read the range at the reduced size.
+    Latencies and retries are counted in `policy` (DEFAULT_RETRY_POLICY if not given), and
+    resyncs back off the way its retries do.
+    """
+    assert window >= 1
+    policy = DEFAULT_RETRY_POLICY if policy is None else policy
+    ranges = iter(ranges)
+    pending = deque()       # to be (re)sent, ahead of anything new from ranges
+    inflight = deque()      # sent, waiting for response, in order
+    done = {}               # completed out of order, waiting for their turn
+    order = deque()         # yield order
+    retry = {}
+    sent_at = {}
+    last_failed = False
+    resyncs = 0
+    known = None            # (address, bytes) verified earlier, for in_step()
+
+    ser.reset_input_buffer()
+    ser.reset_output_buffer()
+
+    try:
+        while True:
+            while len(inflight) < window:
+                if len(pending):
+                    r = pending.popleft()
+                else:
+                    r = next(ranges, None)
+                    if r is None:
+                        break
+                    order.append(r)
+                begin, end = r
+                cmd = range_command(begin, end)
+                ser.write(cmd)
+                METRICS.count('spi_flash_read_range', 'bytes_sent', len(cmd))
+                sent_at[r] = time.time()
+                inflight.append(r)
+
+            while len(order) and order[0] in done:
+                r = order.popleft()
+                yield r[0], r[1], done.pop(r)
+
+            if not len(inflight):
+                if not len(order):
+                    break
+                continue
+
+            begin, end = r = inflight.popleft()
+            expected_length = end - begin + 1 + 4
+            if into is None:
+                line = ser.read(expected_length)
+                data = line[:-4]    # strip CRC32
+                ok = len(line) == expected_length and check_response(line)
+                received = len(line)
+            else:
+                data = into(begin, end)
+                received = ser.readinto(data)
+                crc = ser.read(4) if received == len(data) else b''
+                received += len(crc)
+                ok = received == expected_length and check_crc(data, crc)
+            latency = time.time() - sent_at.pop(r)
+            policy.record('spi_flash_read_range', latency)
+            METRICS.exchange('spi_flash_read_range', latency, received)
+            if ok:
+                done[r] = data
+                last_failed = False
+                resyncs = 0
+                known = (begin, bytes(data[:PROBE_SIZE_BYTE])) if len(data) >= PROBE_SIZE_BYTE else known
+                if feedback is not None:
+                    feedback(begin, end, True)
+                continue
+
+            retry[r] = retry.get(r, 0) + 1
+            parts = feedback(begin, end, False) if feedback is not None else None
+            if received != expected_length:
+                logging.warning('Response length mismatch. Expected {} bytes, got {} bytes'.format(expected_length, received))
+                METRICS.count('spi_flash_read_range', 'short_reads' if received else 'timeouts')
+            else:
+                logging.warning('CRC failure')
+                METRICS.count('spi_flash_read_range', 'crc_failures')
+            # A short response, or two bad ones in a row, means the stream is probably out of step.
+            # Let whatever is still coming arrive (the logger answers everything it was sent),
+            # throw it away, then start over with everything in flight.
+            if received != expected_length or last_failed:
+                METRICS.count('spi_flash_read_range', 'bytes_received', len(ser.read(sum(end - begin + 1 + 4 for begin, end in inflight))))
+                policy.count_retry('spi_flash_read_range', len(inflight))
+                resyncs += 1
+                time.sleep(policy.settle + policy.delay(resyncs))
+                ser.reset_input_buffer()
+                pending.extendleft(reversed(inflight))
+                inflight.clear()
+                last_failed = False
+                if known is None:
+                    ok = in_step(ser, min(begin, SPI_FLASH_SIZE_BYTE - PROBE_SIZE_BYTE), policy=policy)
+                else:
+                    ok = in_step(ser, known[0], known[1], policy=policy)
+                if not ok:
+                    # nothing that comes back can be trusted to be what it looks like
+                    raise InvalidResponseException('Link still out of step after resync')
+            else:
+                last_failed = True
+            if retry[r] >= maxretry:
+                done[r] = bytearray()
+            elif parts:
+                k = order.index(r)
+                del order[k]
+                for p in reversed(parts):
+                    order.insert(k, p)
+                    pending.appendleft(p)
+                    retry[p] = retry[r]
+                policy.count_retry('spi_flash_read_range')
+            else:
+                pending.appendleft(r)
+                policy.count_retry('spi_flash_read_range')
+    finally:
+        # caller may stop early (e.g. on reaching empty memory). Don't leave responses in the pipe.
+        # If it is the port that failed, let that exception through rather than one from here
+        # (serial.SerialException is an OSError).
+        if len(inflight):
+            try:
+                METRICS.count('spi_flash_read_range', 'bytes_received', len(ser.read(sum(end - begin + 1 + 4 for begin, end in inflight))))
+                ser.reset_input_buffer()
+            except OSError:
+                pass
+
+class AdaptiveChunkSize:
+    """Pick the flash read request size on the fly.
+    Double the size after `grow_after` good responses in a row; halve it on every CRC failure
+    or length mismatch, and have the failed range read again in pieces of the new size. Use
+    ranges() as the range source of read_range_pipelined() and pass the object itself as its
+    feedback.
+    """
+    def __init__(self, initial=16*SPI_FLASH_PAGE_SIZE_BYTE, minimum=SPI_FLASH_PAGE_SIZE_BYTE,
+                 maximum=64*SPI_FLASH_PAGE_SIZE_BYTE, grow_after=8):
+        assert minimum <= initial <= maximum
+        self.size = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.grow_after = grow_after
+        self.streak = 0
+        self.byte_count = 0
+        self.failure_count = 0
+        self.starttime = None
+        self.lasttime = None
+        # chunk size: [verified byte count, seconds spent]
+        self.stats = {}
+
+    def ranges(self, begin, end):
+        assert end >= begin
+        if self.starttime is None:
+            self.starttime = self.lasttime = time.time()
+        while begin <= end:
+            stop = min(begin + self.size - 1, end)
+            yield begin, stop
+            begin = stop + 1
+
+    def __call__(self, begin, end, ok):
+        now = time.time()
+        if self.starttime is None:
+            self.starttime = self.lasttime = now
+        size = end - begin + 1
+        tmp = self.stats.setdefault(size, [0, 0])
+        tmp[1] += now - self.lasttime
+        self.lasttime = now
+
+        if ok:
+            self.byte_count += size
+            tmp[0] += size
+            self.streak += 1
+            if self.streak >= self.grow_after and self.size < self.maximum:
+                self.size = min(2*self.size, self.maximum)
+                self.streak = 0
+                logging.debug('Chunk size up to {}'.format(self.size))
+        else:
+            self.failure_count += 1
+            self.streak = 0
+            if self.size > self.minimum:
+                self.size = max(self.size//2, self.minimum)
+                logging.debug('Chunk size down to {}'.format(self.size))
+            if size > self.size:
+                return [(a, min(a + self.size - 1, end)) for a in range(begin, end + 1, self.size)]
+
+    def throughput(self, size=None):
+        """Verified byte/s, either overall or (if size is given) while using that chunk size."""
+        if size is None:
+            if self.starttime is None or self.lasttime <= self.starttime:
+                return 0
+            return self.byte_count/(self.lasttime - self.starttime)
+        byte_count, elapsed = self.stats.get(size, [0, 0])
+        return byte_count/elapsed if elapsed > 0 else 0
+
 def read_page(ser, page):
     #return read_range_core(ser, page*SPI_FLASH_PAGE_SIZE_BYTE, (page+1)*SPI_FLASH_PAGE_SIZE_BYTE - 1)
     begin = page*SPI_FLASH_PAGE_SIZE_BYTE
     end = (page+1)*SPI_FLASH_PAGE_SIZE_BYTE - 1
     return read_range_core(ser, begin, end)
 
-def find_last_used_page(ser):
+def page_in_use(ser, page):
+    """True if anything has been written to the given page. Only reads the first sample in it:
+    a single byte could legitimately be 0xff, but a whole sample can't (that would be NaN)."""
+    from flash_pages import is_erased
+    begin = page*SPI_FLASH_PAGE_SIZE_BYTE
+    r = read_range_core(ser, begin, begin + SAMPLE_SIZE_BYTE - 1)
+    if len(r) != SAMPLE_SIZE_BYTE:
+        raise InvalidResponseException('Cannot read logger memory')
+    return not is_erased(r)
+
+def find_last_used_page(ser, config=None):
     """Find the page address of the last non-empty page. Return None if all of them are empty.
     CAUTION: page address is 0-based. If the result is page N, the number of used pages is N+1.
     CAUTION: it being a binary search means it doesn't actually scan each and every page.
     The assumption is page Q won't get used until page P is used where Q > P.
+
+    If config (from get_logging_config()) is given and has the firmware's write pointer in it,
+    the pointer is checked with one or two probes around it and used if it holds up. Only if
+    it doesn't is the whole memory binary-searched (~16 probes).
     """
-    def is_empty(s):
-        return all([0xff == x for x in s])
+    page_count = SPI_FLASH_SIZE_BYTE//SPI_FLASH_PAGE_SIZE_BYTE
+
+    p = None if config is None else config.get('current_page_addr', None)
+    if p is not None and 0 <= p <= page_count:
+        # The page being written may or may not have made it to the flash yet.
+        if p < page_count and page_in_use(ser, p):
+            if p + 1 >= page_count or not page_in_use(ser, p + 1):
+                return p
+        elif p <= 0:
+            return None
+        elif page_in_use(ser, p - 1):
+            return p - 1
+        logging.debug('Write pointer ({}) is inconsistent with memory content'.format(p))
 
     def search(begin, end):
         logging.debug('search({},{})'.format(begin, end))
@@ -287,35 +819,33 @@ def find_last_used_page(ser):
         if begin >= end:
             assert False
         elif end - begin == 1:
-            #print(is_empty(self.read_page(begin)))
-            #print(is_empty(self.read_page(end)))
-            if not is_empty(read_page(ser, begin)):
+            if page_in_use(ser, begin):
                 return begin
             else:
                 return None
         else:
             mid = int((end + begin)//2)
 
-        # in principle you only need to check the first byte. but god knows how the flash layout might change.
-        if is_empty(read_page(ser, mid)):
+        if not page_in_use(ser, mid):
             return search(begin, mid)
         else:
             return search(mid, end)
 
-    return search(0, SPI_FLASH_SIZE_BYTE//SPI_FLASH_PAGE_SIZE_BYTE)
+    return search(0, page_count)
 
-def get_sample_count(ser):
-    last_page_index = find_last_used_page(ser)
+def get_sample_count(ser, config=None):
+    """Number of samples in memory. Pass the result of get_logging_config() as config to save
+    most of the probing (see find_last_used_page())."""
+    from flash_pages import is_erased, sample_count
+    last_page_index = find_last_used_page(ser, config)
     if last_page_index is None:
         return 0
     buf = read_page(ser, last_page_index)
-    assert not all([0xff == x for x in buf])
-    byte_used = SPI_FLASH_PAGE_SIZE_BYTE - next(k for k,v in enumerate(reversed(buf)) if v not in [0, 0xff])
-    #print(last_page_index, byte_used)
+    assert not is_erased(buf)
     # Careful, last_page_index is 0-based. The number of non-empty pages is last_page_index + 1, but
     # here you are summing up the full pages plus the bits in the last (possibly non-full) page.
     # Really it is (last_page_index + 1 - 1).
-    return last_page_index*(SPI_FLASH_PAGE_SIZE_BYTE//SAMPLE_SIZE_BYTE) + byte_used//SAMPLE_SIZE_BYTE
+    return last_page_index*(SPI_FLASH_PAGE_SIZE_BYTE//SAMPLE_SIZE_BYTE) + sample_count(buf)
     # huh. is A//X + B//X === (A + B)//X? Is the // operator distributive? Can I do
     # (last_page*SPI_FLASH_PAGE_SIZE_BYTE + byte_used)//SAMPLE_SIZE_BYTE?
     # Nope. 7//10 + 3//10 != 10//10
@@ -0,0 +1,215 @@
+# asyncio version of the logger commands in common.py.
+#
+# Same commands, same parsing (the parsers in common.py), but as coroutines on a
+# (StreamReader, StreamWriter) pair, so one event loop can talk to many loggers at once. Retries
+# go through the same RetryPolicy. Every read has a timeout, and every coroutine can be cancelled
+# (asyncio.wait_for(), Task.cancel()) without leaving the logger half-answered: the next command
+# flushes whatever was left in the input.
+#
+# Opening a serial port needs pyserial-asyncio (pip install pyserial-asyncio). Anything else that
+# gives a StreamReader/StreamWriter pair (a TCP serial bridge, say) works with AsyncLogger directly.
+#
+# The blocking functions in common.py do the same over a Serial, and share the parsers, the
+# RetryPolicy and the link METRICS with these; use them when there is only one logger.
+#
+# MESHLAB, UH Manoa
+import asyncio, logging, time
+from dev.crc_check import check_response
+from link_metrics import METRICS
+from common import MAX_RETRY, DEFAULT_RETRY_POLICY, InvalidResponseException, Attempt,\
+     parse_is_logging, parse_logging_config, parse_vbatt, parse_logger_name, parse_flash_id, range_command
+
+
+async def attempts(policy, name, maxretry=None, deadline=None):
+    """RetryPolicy.attempts(), waiting between attempts without blocking the event loop."""
+    maxretry = policy.maxretry if maxretry is None else maxretry
+    deadline = policy.deadline if deadline is None else deadline
+    starttime = time.time()
+    silent = 0
+    for i in range(maxretry):
+        if i > 0:
+            delay = policy.retrying(name, i, starttime, deadline)
+            if delay is None:
+                return
+            await asyncio.sleep(delay)
+        attempt = Attempt(policy, name)
+        yield attempt
+        silent = silent + 1 if attempt.silent else 0
+        if policy.dead_after and silent >= policy.dead_after:
+            logging.debug('{}(): no response at all. Giving up.'.format(name))
+            return
+
+
+class AsyncLogger:
+    """timeout is how long readline() waits, and how long read(n) waits on top of the time n
+    bytes take at baudrate."""
+    def __init__(self, reader, writer, timeout=1, baudrate=115200, policy=None):
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.baudrate = baudrate
+        self.policy = DEFAULT_RETRY_POLICY if policy is None else policy
+        # True unless the last exchange finished cleanly (it may have been cancelled halfway)
+        self.dirty = True
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (OSError, ConnectionError):
+            pass
+
+    async def flush(self):
+        """Discard whatever is waiting in the input (the equivalent of ser.reset_input_buffer())."""
+        while True:
+            try:
+                r = await asyncio.wait_for(self.reader.read(4096), 0.01)
+            except asyncio.TimeoutError:
+                return
+            if not len(r):
+                return
+
+    async def write(self, cmd):
+        self.writer.write(cmd)
+        await self.writer.drain()
+
+    async def send(self, attempt, cmd):
+        attempt.send(self.writer, cmd)
+        await self.writer.drain()
+
+    async def readline(self):
+        """Like Serial.readline(): empty on timeout."""
+        try:
+            return await asyncio.wait_for(self.reader.readline(), self.timeout)
+        except asyncio.TimeoutError:
+            return b''
+
+    async def read(self, n):
+        """Like Serial.read(): up to n bytes, fewer on timeout."""
+        buf = bytearray()
+        loop = asyncio.get_running_loop()
+        # 10 bits a byte on the wire
+        deadline = loop.time() + self.timeout + n*10/self.baudrate
+        while len(buf) < n:
+            try:
+                r = await asyncio.wait_for(self.reader.read(n - len(buf)), max(deadline - loop.time(), 0))
+            except asyncio.TimeoutError:
+                break
+            if not len(r):
+                break
+            buf.extend(r)
+        return bytes(buf)
+
+    async def command(self, name, cmd, parse, maxretry=None):
+        """Same as common.command(): send cmd until parse() makes sense of the response line."""
+        async for attempt in attempts(self.policy, name, maxretry):
+            # before every retry too: the rest of a cancelled response may still be coming in
+            if self.dirty:
+                await self.flush()
+            self.dirty = True
+            await self.send(attempt, cmd)
+            r = attempt.got(await self.readline())
+            logging.debug(r)
+            try:
+                r = parse(r)
+            except ValueError:
+                logging.debug('{}(): invalid response {}'.format(name, r))
+                continue
+            self.dirty = False
+            return r
+        raise InvalidResponseException('Invalid/no response from logger')
+
+    async def is_logging(self, maxretry=None):
+        logging.debug('is_logging()')
+        return await self.command('is_logging', b'is_logging', parse_is_logging, maxretry)
+
+    async def get_logging_config(self, maxretry=None):
+        logging.debug('get_logging_config()')
+        return await self.command('get_logging_config', b'get_logging_config', parse_logging_config, maxretry)
+
+    async def read_vbatt(self, maxretry=None):
+        logging.debug('read_vbatt()')
+        return await self.command('read_sys_volt', b'read_sys_volt', parse_vbatt, maxretry)
+
+    async def get_logger_name(self, maxretry=None):
+        logging.debug('get_logger_name()')
+        try:
+            return await self.command('get_logger_name', b'get_logger_name', parse_logger_name, maxretry)
+        except InvalidResponseException:
+            return ''
+
+    async def get_flash_id(self, maxretry=None):
+        logging.debug('get_flash_id()')
+        return await self.command('get_flash_id', b'spi_flash_get_unique_id', parse_flash_id, maxretry)
+
+    async def get_metadata(self, maxretry=None):
+        config = {}
+        config['flash_id'] = await self.get_flash_id(maxretry)
+        config['logger_name'] = await self.get_logger_name(maxretry)
+        config['is_logging'] = await self.is_logging()
+        metadata = await self.get_logging_config(maxretry)
+        config['logging_start_time'] = metadata['logging_start_time']
+        config['logging_stop_time'] = metadata['logging_stop_time']
+        config['logging_interval_code'] = metadata['logging_interval_code']
+        return config
+
+    async def read_range_core(self, begin, end):
+        cmd = range_command(begin, end)
+
+        # no deadline, as in common.read_range_core()
+        self.dirty = True
+        async for attempt in attempts(self.policy, 'spi_flash_read_range', MAX_RETRY, deadline=float('inf')):
+            await self.flush()
+            await self.send(attempt, cmd)
+            expected_length = end - begin + 1 + 4
+            line = attempt.got(await self.read(expected_length))
+            if len(line) != expected_length:
+                await asyncio.sleep(self.policy.settle)
+                logging.warning('Response length mismatch. Expected {} bytes, got {} bytes'.format(expected_length, len(line)))
+                if len(line):
+                    METRICS.count('spi_flash_read_range', 'short_reads')
+                continue
+            if not check_response(line):
+                await asyncio.sleep(self.policy.settle)
+                logging.warning('CRC failure')
+                METRICS.count('spi_flash_read_range', 'crc_failures')
+                continue
+
+            self.dirty = False
+            return line[:-4]    # strip CRC32
+        return bytearray()
+
+
+async def open_logger(port, baudrate=115200, timeout=1):
+    """Open a serial port and return an AsyncLogger on it. Needs pyserial-asyncio."""
+    import serial_asyncio
+    reader, writer = await serial_asyncio.open_serial_connection(url=port, baudrate=baudrate)
+    return AsyncLogger(reader, writer, timeout=timeout, baudrate=baudrate)
+
+
+if '__main__' == __name__:
+
+    # Status of every logger attached, all polled at the same time.
+    import serial.tools.list_ports
+
+    logging.basicConfig(level=logging.WARNING)
+
+    async def status(port):
+        try:
+            async with await open_logger(port) as logger:
+                return port, await asyncio.wait_for(logger.get_metadata(maxretry=3), 10)
+        except (InvalidResponseException, asyncio.TimeoutError, OSError):
+            return port, None
+
+    async def main():
+        ports = sorted(c.device for c in serial.tools.list_ports.comports())
+        for port, config in await asyncio.gather(*[status(port) for port in ports]):
+            print('{}\t{}'.format(port, config if config is not None else '(no logger)'))
+
+    asyncio.run(main())
@@ -0,0 +1,148 @@
+# Download throughput benchmark: read_memory.download() against the emulated logger under a few
+# link conditions, for a few chunk sizes, pipeline windows and retry settings, on 1, 4 and 16MB
+# of data.
+#
+# Writes a JSON report (one record per run: bytes/s, requests sent, retries, CRC failures and
+# short reads, bytes received beyond the data itself, link and wall time...) and prints a table. Give it a previous
+# report to compare against and it flags every run that got more than REGRESSION_THRESHOLD slower:
+#
+#   python -m dev.benchmark_download                      (from the top-level directory)
+#   python -m dev.benchmark_download baseline.json
+#
+# Link time is the emulator's clock (see dev/emulator.py): simulated transfer time plus whatever
+# the host really spent. It is what the same download would take over such a link.
+#
+# MESHLAB, UH Manoa
+import sys, time, json, logging, platform, tempfile
+from os import remove
+from os.path import join, exists
+import read_memory
+from common import SPI_FLASH_PAGE_SIZE_BYTE, SAMPLE_PER_PAGE, RetryPolicy
+from link_metrics import METRICS
+from download_manifest import manifest_name
+from dev.emulator import LoggerEmulator, synthetic_flash
+
+
+# the retry warnings would drown the table
+logging.getLogger().setLevel(logging.ERROR)
+
+
+# name: LoggerEmulator settings
+PROFILES = {
+    'clean_usb': {'byte_rate': 100000, 'latency': 0.002},
+    'noisy_long_cable': {'byte_rate': 100000, 'latency': 0.005, 'corrupt_rate': 2e-6, 'drop_rate': 5e-7},
+    'high_latency_adapter': {'byte_rate': 50000, 'latency': 0.05},
+}
+# amount of data in the logger, in MB
+SIZES_MB = [1, 4, 16]
+# request size in byte. None = read_memory's adaptive chunk size
+CHUNK_SIZES = [4*SPI_FLASH_PAGE_SIZE_BYTE, 16*SPI_FLASH_PAGE_SIZE_BYTE, 64*SPI_FLASH_PAGE_SIZE_BYTE, None]
+# requests in flight. 1 = one at a time
+PIPELINE_WINDOWS = [1, 4]
+# name: RetryPolicy settings ({} = the defaults)
+RETRY_POLICIES = {
+    'default': {},
+    'eager': {'backoff': 0.01, 'backoff_max': 0.1, 'settle': 0.02},
+    'patient': {'backoff': 0.1, 'backoff_max': 1.6, 'settle': 0.2},
+}
+# report this run as a regression if its bytes/s dropped by more than this fraction from the baseline
+REGRESSION_THRESHOLD = 0.1
+REPORT = 'benchmark_download.json'
+
+
+def run(image, size, profile, chunk_size, window, retry_policy='default', seed=0):
+    """Download `size` bytes from an emulated logger holding `image`. Return a report record."""
+    ser = LoggerEmulator(image=image, seed=seed, **PROFILES[profile])
+    policy = RetryPolicy(**RETRY_POLICIES[retry_policy])
+    read_memory.CHUNK_SIZE = chunk_size if chunk_size is not None else 16*SPI_FLASH_PAGE_SIZE_BYTE
+    read_memory.ADAPTIVE_CHUNK_SIZE = chunk_size is None
+    read_memory.PIPELINE_WINDOW = window
+
+    fn_bin = join(tempfile.gettempdir(), 'benchmark_download.bin')
+    fn_manifest = manifest_name(fn_bin)
+    METRICS.reset()
+    starttime = time.time()
+    try:
+        read_memory.download(ser, fn_bin, end=size - 1, verbose=False, policy=policy)
+        wall = time.time() - starttime
+        ok = open(fn_bin, 'rb').read() == image[:size]
+    finally:
+        for fn in [fn_bin, fn_manifest]:
+            if exists(fn):
+                remove(fn)
+
+    return {'profile': profile,
+            'size': size,
+            'chunk_size': chunk_size if chunk_size is not None else 'adaptive',
+            'window': window,
+            'retry_policy': retry_policy,
+            'ok': ok,
+            'link_time': round(ser.clock, 3),
+            'wall_time': round(wall, 3),
+            'byte_per_second': round(size/ser.clock),
+            'requests': ser.command_count,
+            'retries': sum(policy.retries.values()),
+            'crc_failures': METRICS.total('crc_failures'),
+            'short_reads': METRICS.total('short_reads') + METRICS.total('timeouts'),
+            'overhead_bytes': ser.byte_read - size,
+            }
+
+def key(r):
+    # reports from before the retry policy sweep only have the defaults
+    return r['profile'], r['size'], str(r['chunk_size']), r['window'], r.get('retry_policy', 'default')
+
+def compare(results, baseline):
+    """Return the runs that got slower than the baseline, as (record, baseline record)."""
+    before = {key(r): r for r in baseline}
+    slower = []
+    for r in results:
+        b = before.get(key(r))
+        if b is not None and r['byte_per_second'] < b['byte_per_second']*(1 - REGRESSION_THRESHOLD):
+            slower.append((r, b))
+    return slower
+
+
+if '__main__' == __name__:
+
+    baseline = json.load(open(sys.argv[1]))['results'] if len(sys.argv) > 1 else None
+
+    print('Generating flash image...')
+    full = bytes(synthetic_flash(max(SIZES_MB)*1024*1024//SPI_FLASH_PAGE_SIZE_BYTE*SAMPLE_PER_PAGE))
+
+    results = []
+    print('profile\tsize(MB)\tchunk\twindow\tretry\tkB/s\trequests\tretries\tcrc/short\toverhead(B)\tlink(s)\twall(s)')
+    for profile in PROFILES:
+        for size_mb in SIZES_MB:
+            size = size_mb*1024*1024
+            image = full[:size]
+            for chunk_size in CHUNK_SIZES:
+                for window in PIPELINE_WINDOWS:
+                    for retry_policy in RETRY_POLICIES:
+                        r = run(image, size, profile, chunk_size, window, retry_policy)
+                        results.append(r)
+                        print('{}\t{}\t{}\t{}\t{}\t{:.1f}\t{}\t{}\t{}/{}\t{}\t{:.1f}\t{:.1f}{}'.format(
+                              profile, size_mb, r['chunk_size'], window, retry_policy, r['byte_per_second']/1e3,
+                              r['requests'], r['retries'], r['crc_failures'], r['short_reads'], r['overhead_bytes'],
+                              r['link_time'], r['wall_time'], '' if r['ok'] else '\tDATA MISMATCH'))
+
+    report = {'time': time.time(), 'python': platform.python_version(), 'profiles': PROFILES,
+              'retry_policies': RETRY_POLICIES, 'results': results}
+    with open(REPORT, 'w') as fout:
+        json.dump(report, fout, indent=2)
+    print('Report: {}'.format(REPORT))
+
+    bad = [r for r in results if not r['ok']]
+    if len(bad):
+        print('{} run(s) downloaded the wrong data!'.format(len(bad)))
+
+    if baseline is not None:
+        slower = compare(results, baseline)
+        for r, b in slower:
+            print('SLOWER: {} {}MB chunk={} window={} retry={}: {:.1f} kB/s (was {:.1f})'.format(
+                  r['profile'], r['size']//1024//1024, r['chunk_size'], r['window'], r['retry_policy'],
+                  r['byte_per_second']/1e3, b['byte_per_second']/1e3))
+        if not len(slower):
+            print('No regression against {}.'.format(sys.argv[1]))
+
+    if len(bad) or (baseline is not None and len(compare(results, baseline))):
+        sys.exit(1)
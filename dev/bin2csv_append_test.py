@@ -0,0 +1,67 @@
+# Check that bin2csv's append (what an incremental download does to the CSV) adds exactly the rows
+# a fresh conversion of the grown .bin has after those already in the CSV, including when a page
+# in the middle of the file ends early at a NaN sample.
+#
+#   python -m dev.bin2csv_append_test                     (from the top-level directory)
+#
+# MESHLAB, UH Manoa
+import struct, tempfile
+from os.path import join
+import bin2csv
+from common import SPI_FLASH_PAGE_SIZE_BYTE, SAMPLE_SIZE_BYTE, SAMPLE_PER_PAGE
+from dev.emulator import synthetic_flash
+
+
+CONFIG = {'logging_start_time': 1546300800, 'logging_interval_code': 1}
+SAMPLE_COUNT = 2000
+# this page ends at a (written) NaN sample, SHORT_AT samples in
+SHORT_PAGE = 40
+SHORT_AT = 7
+
+
+def image(sample_count):
+    """sample_count samples' worth of flash, the rest of the last page erased, with SHORT_PAGE cut short."""
+    page_count = -(-sample_count//SAMPLE_PER_PAGE)
+    buf = synthetic_flash(sample_count)[:page_count*SPI_FLASH_PAGE_SIZE_BYTE]
+    struct.pack_into('f', buf, SHORT_PAGE*SPI_FLASH_PAGE_SIZE_BYTE + SHORT_AT*SAMPLE_SIZE_BYTE, float('nan'))
+    return bytes(buf)
+
+def check(convert, folder):
+    fn_bin = join(folder, 'a.bin')
+    fn_csv = join(folder, 'a.csv')
+    fn_fresh = join(folder, 'fresh.csv')
+
+    with open(fn_bin, 'wb') as fout:
+        fout.write(image(SAMPLE_COUNT))
+    convert(fn_bin, fn_fresh, CONFIG)
+    expected = open(fn_fresh).read()
+
+    # first download ends halfway through a page; the next one picks up from there
+    for first in [SAMPLE_COUNT//3 + 5, SHORT_PAGE*SAMPLE_PER_PAGE + 3]:
+        with open(fn_bin, 'wb') as fout:
+            fout.write(image(first))
+        convert(fn_bin, fn_csv, CONFIG)
+        with open(fn_bin, 'wb') as fout:
+            fout.write(image(SAMPLE_COUNT))
+        convert(fn_bin, fn_csv, CONFIG, append=True)
+        got = open(fn_csv).read()
+        assert got == expected, '{}: {} rows after append, {} in a fresh conversion'.format(
+               convert.__name__, bin2csv.count_csv_rows(fn_csv), bin2csv.count_csv_rows(fn_fresh))
+    # nothing new: nothing added
+    convert(fn_bin, fn_csv, CONFIG, append=True)
+    assert open(fn_csv).read() == expected
+
+def sharded(fn_bin, fn_csv, config, append=False):
+    return bin2csv.bin2csv_sharded(fn_bin, fn_csv, config, append=append, workers=3)
+
+def test_append_after_short_page():
+    # small enough that the sharded conversion really splits a file this size
+    bin2csv.MIN_SHARD_PAGE_COUNT = 8
+    with tempfile.TemporaryDirectory() as folder:
+        check(bin2csv.bin2csv, folder)
+        check(sharded, folder)
+
+
+if '__main__' == __name__:
+    test_append_after_short_page()
+    print('OK')
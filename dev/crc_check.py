@@ -5,7 +5,6 @@
 # Copyright 2018 Stanley H.I. Lio
 # hlio@hawaii.edu
 import struct, binascii
-from serial import Serial
 
 
 def check_page(buf):
@@ -18,10 +17,16 @@ def check_response(r):
     expected = binascii.crc32(r[:len(r) - 4])
     actual = int.from_bytes(r[len(r) - 4:], byteorder='little')
     return actual == expected
+
+def check_crc(data, crc):
+    """Same as check_response(), for when the data and its CRC32 are in separate buffers."""
+    return binascii.crc32(data) == int.from_bytes(crc, byteorder='little')
     
 
 if '__main__' == __name__:
 
+    from serial import Serial
+
     with Serial('COM4', 115200, timeout=1) as ser:
 
         startaddr = 0
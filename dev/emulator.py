@@ -0,0 +1,376 @@
+# A logger that isn't there: an in-process stand-in for Serial(PORT) with a logger on the other end.
+#
+# LoggerEmulator implements the firmware commands the scripts in this repo use (is_logging,
+# get_logging_config, spi_flash_read_range with its CRC32 trailer, read_sys_volt, read_rtc,
+# write_rtc, clear_memory, start/stop_logging, the sensor reads...) over a 16MB flash image,
+# either filled with synthetic samples or loaded from a .bin file. Pass it wherever a Serial is
+# expected:
+#
+#   ser = LoggerEmulator(sample_count=100000)
+#   print(get_sample_count(ser, get_logging_config(ser)))
+#
+# Link timing is simulated: the logger sends byte_rate bytes per second (it's USB, so the baud
+# rate setting doesn't matter), and takes `latency` seconds to start answering a command.
+# Waiting on the logger happens on a virtual clock (ser.clock) by default, so nothing actually
+# waits, which is what you want for benchmarks; time spent on the host side (computing,
+# time.sleep()) counts as it really passes. realtime=True makes the waits real too.
+# drop_rate and corrupt_rate are per-byte probabilities of a byte getting lost or garbled on
+# the way to the host.
+#
+# Run this file (python -m dev.emulator) to put an emulated logger on a pseudo-terminal that
+# the regular scripts can open like any serial port (Linux/macOS only).
+#
+# MESHLAB, UH Manoa
+import time, math, random, struct, binascii, logging, re
+from collections import deque
+from common import SPI_FLASH_SIZE_BYTE, SPI_FLASH_PAGE_SIZE_BYTE, SAMPLE_SIZE_BYTE, SAMPLE_PER_PAGE, SAMPLE_INTERVAL_CODE_MAP
+
+
+# commands that take an argument end with '\n'. The rest are matched as they are.
+COMMANDS_WITH_ARGUMENT = [b'spi_flash_read_range', b'set_logger_name', b'write_rtc', b'set_logging_interval']
+COMMANDS = [b'is_logging', b'get_logging_config', b'get_logger_name', b'spi_flash_get_unique_id', b'read_sys_volt',
+            b'read_rtc', b'start_logging', b'stop_logging', b'clear_memory', b'read_temperature', b'read_pressure',
+            b'read_ambient_lx', b'read_white_lx', b'read_rgbw', b'red_led_on', b'red_led_off', b'green_led_on',
+            b'green_led_off', b'blue_led_on', b'blue_led_off', b'help']
+
+
+def synthetic_flash(sample_count, seed=0):
+    """A flash image holding sample_count made-up samples, laid out the way the firmware does it:
+    12 samples per 256-byte page, the last 16 bytes of each page unused, 0xff where nothing was written."""
+    assert 0 <= sample_count <= SPI_FLASH_SIZE_BYTE//SPI_FLASH_PAGE_SIZE_BYTE*SAMPLE_PER_PAGE
+    rnd = random.Random(seed)
+    flash = bytearray(b'\xff'*SPI_FLASH_SIZE_BYTE)
+    s = struct.Struct('ffHHHHHH')
+    for i in range(sample_count):
+        page, k = divmod(i, SAMPLE_PER_PAGE)
+        light = int(2000 + 1800*math.sin(i/5000))
+        s.pack_into(flash, page*SPI_FLASH_PAGE_SIZE_BYTE + k*SAMPLE_SIZE_BYTE,
+                    25 + 3*math.sin(i/10000) + rnd.gauss(0, 0.01),
+                    101.3 + 0.5*math.sin(i/3000) + rnd.gauss(0, 0.005),
+                    light, light//2, light//4, light//3, light//5, light//2)
+    return flash
+
+
+class LoggerEmulator:
+    def __init__(self, sample_count=0, image=None, flash_id='E0123456789ABCDE', logger_name='emulated',
+                 logging_start_time=1546300800, logging_interval_code=1, running=False,
+                 baudrate=115200, byte_rate=100000, latency=0.002, drop_rate=0, corrupt_rate=0, timeout=1,
+                 realtime=False, seed=0):
+        if image is not None:
+            self.flash = bytearray(b'\xff'*SPI_FLASH_SIZE_BYTE)
+            self.flash[:len(image)] = image
+            used = len(bytes(image).rstrip(b'\xff'))
+            page, byte_i = divmod(used, SPI_FLASH_PAGE_SIZE_BYTE)
+            sample_count = page*SAMPLE_PER_PAGE + -(-byte_i//SAMPLE_SIZE_BYTE)
+        else:
+            self.flash = synthetic_flash(sample_count, seed)
+        self.sample_count = sample_count
+        self.flash_id = flash_id
+        self.logger_name = logger_name
+        self.logging_start_time = logging_start_time if sample_count > 0 or running else 0
+        self.logging_stop_time = 0 if running or sample_count <= 0 else \
+                                 int(logging_start_time + sample_count*SAMPLE_INTERVAL_CODE_MAP[logging_interval_code])
+        self.logging_interval_code = logging_interval_code
+        self.running = running
+        self.rtc_offset = 0
+
+        self.baudrate = baudrate
+        self.byte_rate = byte_rate
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.timeout = timeout
+        self.realtime = realtime
+        self.random = random.Random(seed)
+        self.is_open = True
+
+        # virtual clock, in second
+        self.clock = 0
+        self.last_call = time.monotonic()
+        # the logger is busy answering until this time
+        self.busy_until = 0
+        # bytes received but not yet understood
+        self.rx = bytearray()
+        # responses on their way to the host: [time the first byte arrives, data, bytes already read]
+        self.tx = deque()
+        # traffic counters
+        self.byte_written = 0
+        self.byte_read = 0
+        self.command_count = 0
+
+    # - - - the Serial side - - -
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        self.is_open = False
+
+    def byte_time(self, n=1):
+        return n/self.byte_rate
+
+    def sync(self):
+        """Time the host spends between calls (computing, sleeping) passes on the clock too."""
+        now = time.monotonic()
+        self.clock += now - self.last_call
+        self.last_call = now
+
+    def advance(self, t):
+        """Move the clock forward to t: the host is waiting on the logger. Only in realtime mode
+        does the wait actually happen."""
+        if t > self.clock:
+            if self.realtime:
+                time.sleep(t - self.clock)
+            self.clock = t
+        self.last_call = time.monotonic()
+
+    def sleep(self, second):
+        """time.sleep() on the emulator's clock: in virtual mode the time passes without the wait."""
+        self.sync()
+        self.advance(self.clock + second)
+
+    def write(self, data):
+        self.sync()
+        self.byte_written += len(data)
+        # the command is only complete once its last byte is through
+        self.rx.extend(data)
+        self.parse(self.clock + self.byte_time(len(data)))
+        return len(data)
+
+    def read(self, size=1):
+        return self._read(size, None)
+
+    def readline(self, size=-1):
+        return self._read(size if size >= 0 else float('inf'), b'\n')
+
+    def readinto(self, b):
+        m = memoryview(b).cast('B')
+        r = self.read(len(m))
+        m[:len(r)] = r
+        return len(r)
+
+    def _read(self, size, terminator):
+        self.sync()
+        deadline = self.clock + self.timeout if self.timeout is not None else float('inf')
+        out = bytearray()
+        while len(out) < size and len(self.tx):
+            chunk = self.tx[0]
+            start, data, pos = chunk
+            take = int(min(size - len(out), len(data) - pos))
+            if terminator is not None:
+                k = data.find(terminator, pos, pos + take)
+                if k >= 0:
+                    take = k - pos + 1
+            arrival = start + self.byte_time(pos + take)
+            if arrival > deadline:
+                take = max(0, min(take, int((deadline - start)/self.byte_time()) - pos))
+                out.extend(data[pos:pos + take])
+                chunk[2] += take
+                break
+            out.extend(data[pos:pos + take])
+            chunk[2] += take
+            self.advance(arrival)
+            if chunk[2] >= len(data):
+                self.tx.popleft()
+            if terminator is not None and out.endswith(terminator):
+                break
+        if len(out) < size and (terminator is None or not out.endswith(terminator)) and deadline < float('inf'):
+            self.advance(deadline)      # waited in vain
+        self.byte_read += len(out)
+        return bytes(out)
+
+    @property
+    def in_waiting(self):
+        self.sync()
+        n = 0
+        for start, data, pos in self.tx:
+            n += max(0, min(len(data), int((self.clock - start)/self.byte_time())) - pos)
+        return n
+
+    def reset_input_buffer(self):
+        """Throw away whatever has arrived. Whatever is still on its way keeps coming."""
+        self.sync()
+        while len(self.tx):
+            start, data, pos = self.tx[0]
+            arrived = min(len(data), int((self.clock - start)/self.byte_time()))
+            if arrived >= len(data):
+                self.tx.popleft()
+            else:
+                self.tx[0][2] = max(pos, arrived)
+                break
+
+    def reset_output_buffer(self):
+        pass
+
+    flushInput = reset_input_buffer
+    flushOutput = reset_output_buffer
+
+    # - - - the firmware side - - -
+
+    def parse(self, t):
+        while len(self.rx):
+            if self.rx[0] in b'\r\n ':
+                del self.rx[0]
+                continue
+            for cmd in COMMANDS_WITH_ARGUMENT:
+                if self.rx.startswith(cmd):
+                    k = self.rx.find(b'\n')
+                    if k < 0:
+                        return      # wait for the rest of it
+                    arg = bytes(self.rx[len(cmd):k])
+                    del self.rx[:k + 1]
+                    self.execute(cmd, arg, t)
+                    break
+            else:
+                for cmd in sorted(COMMANDS, key=len, reverse=True):
+                    if self.rx.startswith(cmd):
+                        del self.rx[:len(cmd)]
+                        self.execute(cmd, b'', t)
+                        break
+                else:
+                    if any(cmd.startswith(bytes(self.rx)) for cmd in COMMANDS + COMMANDS_WITH_ARGUMENT):
+                        return      # wait for the rest of it
+                    logging.debug('emulator: gibberish {}'.format(bytes(self.rx[:1])))
+                    del self.rx[0]
+
+    def respond(self, data, t):
+        if self.drop_rate > 0 or self.corrupt_rate > 0:
+            data = self.garble(data)
+        start = max(t + self.latency, self.busy_until)
+        self.busy_until = start + self.byte_time(len(data))
+        self.tx.append([start, data, 0])
+
+    def garble(self, data):
+        data = bytearray(data)
+        for rate, drop in [(self.corrupt_rate, False), (self.drop_rate, True)]:
+            if rate <= 0:
+                continue
+            k = -1
+            while True:
+                # jump straight to the next victim (geometric gaps) instead of rolling dice for every byte
+                k += int(math.log(1 - self.random.random())/math.log(1 - rate)) + 1 if rate < 1 else 1
+                if k >= len(data):
+                    break
+                if drop:
+                    del data[k]
+                    k -= 1
+                else:
+                    data[k] ^= 1 << self.random.randrange(8)
+        return bytes(data)
+
+    def rtc(self):
+        return int(time.time() + self.rtc_offset)
+
+    def pointers(self):
+        page, k = divmod(self.sample_count, SAMPLE_PER_PAGE)
+        return page, k*SAMPLE_SIZE_BYTE
+
+    def execute(self, cmd, arg, t):
+        self.command_count += 1
+        if b'is_logging' == cmd:
+            self.respond('{},{},{}\r\n'.format(int(self.running), *self.pointers()).encode(), t)
+        elif b'get_logging_config' == cmd:
+            self.respond('{},{},{},{},{}\r\n'.format(self.logging_start_time, self.logging_stop_time,
+                                                     self.logging_interval_code, *self.pointers()).encode(), t)
+        elif b'spi_flash_read_range' == cmd:
+            m = re.fullmatch(rb'([0-9a-fA-F]+),([0-9a-fA-F]+)', arg)
+            if m is None:
+                return
+            begin, end = int(m.group(1), 16), int(m.group(2), 16)
+            if not (begin <= end < SPI_FLASH_SIZE_BYTE):
+                return
+            data = bytes(self.flash[begin:end + 1])
+            self.respond(data + binascii.crc32(data).to_bytes(4, byteorder='little'), t)
+        elif b'spi_flash_get_unique_id' == cmd:
+            self.respond(self.flash_id.encode() + b'\r\n', t)
+        elif b'get_logger_name' == cmd:
+            name = self.logger_name.encode() if len(self.logger_name) else b'\xff'*15
+            self.respond(name + b'\r\n', t)
+        elif b'set_logger_name' == cmd:
+            self.logger_name = arg.decode(errors='replace')[:15]
+        elif b'read_sys_volt' == cmd:
+            self.respond(b'3.30,2.95\r\n', t)
+        elif b'read_rtc' == cmd:
+            self.respond('{}\r\n'.format(self.rtc()).encode(), t)
+        elif b'write_rtc' == cmd:
+            try:
+                self.rtc_offset = int(arg) - time.time()
+                self.respond('{}\r\n'.format(int(arg)).encode(), t)
+            except ValueError:
+                pass
+        elif b'set_logging_interval' == cmd:
+            try:
+                if int(arg) in SAMPLE_INTERVAL_CODE_MAP:
+                    self.logging_interval_code = int(arg)
+            except ValueError:
+                pass
+        elif b'start_logging' == cmd:
+            # memory must be cleared first
+            if not self.running and 0 == self.sample_count:
+                self.running = True
+                self.logging_start_time = self.rtc()
+                self.logging_stop_time = 0
+        elif b'stop_logging' == cmd:
+            if self.running:
+                self.running = False
+                self.logging_stop_time = self.rtc()
+        elif b'clear_memory' == cmd:
+            self.flash[:] = b'\xff'*SPI_FLASH_SIZE_BYTE
+            self.sample_count = 0
+            self.logging_start_time = 0
+            self.logging_stop_time = 0
+            self.respond(b'.'*64 + b'done.\r\n', t)
+        elif b'read_temperature' == cmd:
+            self.respond('{:.3f} Deg.C\r\n'.format(25 + self.random.gauss(0, 0.01)).encode(), t)
+        elif b'read_pressure' == cmd:
+            self.respond('{:.3f} kPa\r\n'.format(101.325 + self.random.gauss(0, 0.005)).encode(), t)
+        elif cmd in [b'read_ambient_lx', b'read_white_lx']:
+            self.respond(b'123.45 lx,1234\r\n', t)
+        elif b'read_rgbw' == cmd:
+            self.respond(b'100,200,300,400\r\n', t)
+        elif b'help' == cmd:
+            self.respond(b' '.join(COMMANDS_WITH_ARGUMENT + COMMANDS) + b'\r\n', t)
+        # LEDs: nothing to say
+
+
+def serve_pty(emulator):
+    """Serve the emulator on a pseudo-terminal until interrupted. Open the printed device
+    with Serial() like any other port."""
+    import os, tty, select
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    print('Emulated logger on {}'.format(os.ttyname(slave)))
+    emulator.realtime = True
+    emulator.timeout = 0
+    try:
+        while True:
+            r, _, _ = select.select([master], [], [], 0.001)
+            if len(r):
+                emulator.write(os.read(master, 4096))
+            n = emulator.in_waiting
+            if n > 0:
+                os.write(master, emulator.read(n))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.close(master)
+        os.close(slave)
+
+
+if '__main__' == __name__:
+
+    import sys
+
+    logging.basicConfig(level=logging.WARNING)
+
+    # python -m dev.emulator [sample count | path to a .bin]
+    arg = sys.argv[1] if len(sys.argv) > 1 else '100000'
+    if arg.isdigit():
+        emulator = LoggerEmulator(sample_count=int(arg))
+    else:
+        emulator = LoggerEmulator(image=open(arg, 'rb').read())
+    print('{} sample(s) in memory.'.format(emulator.sample_count))
+    serve_pty(emulator)
@@ -0,0 +1,221 @@
+# Record a serial session to a file, and play it back without the logger.
+#
+# RecordingSerial wraps a Serial and logs every write, read, buffer reset and in_waiting poll
+# with its time and duration. ReplaySerial reads the log back and answers the same calls with
+# the same bytes, taking the same time (or no time at all, or anything in between), so a
+# session from the field can be run through common.py again and again on a desk:
+#
+#   with RecordingSerial(Serial(PORT, 115200, timeout=1), 'session.trace') as ser:
+#       ...
+#   with ReplaySerial('session.trace', speed=10) as ser:
+#       ...same calls as before...
+#
+# The replay only works as long as the code makes the same calls in the same order (same
+# commands, same read sizes); the first call that differs raises TranscriptMismatch.
+# read_memory.py records its sessions when TRANSCRIPT is set.
+#
+# File format: b'HLTR', a version byte, then one record per call:
+#   kind (1 byte), start time since opening (float64), duration (float32),
+#   argument (int32: size asked for, -1 when there isn't one), data length (uint32), data
+# all little-endian. Kinds: W write, R read/readinto, L readline, I reset_input_buffer,
+# O reset_output_buffer, N in_waiting (the count is the argument).
+#
+# python -m dev.transcript session.trace     prints what is in a trace.
+#
+# MESHLAB, UH Manoa
+import time, struct, logging
+
+
+MAGIC = b'HLTR'
+VERSION = 1
+RECORD = struct.Struct('<cdfiI')
+
+
+class TranscriptMismatch(Exception):
+    pass
+
+
+def load(fn):
+    """Return the records in a trace as a list of (kind, start, duration, argument, data)."""
+    records = []
+    with open(fn, 'rb') as fin:
+        header = fin.read(len(MAGIC) + 1)
+        if not header.startswith(MAGIC) or VERSION != header[-1]:
+            raise ValueError('{} is not a transcript (or is from a different version)'.format(fn))
+        while True:
+            r = fin.read(RECORD.size)
+            if len(r) < RECORD.size:
+                break       # a recording cut short keeps everything up to its last full record
+            kind, start, duration, argument, length = RECORD.unpack(r)
+            data = fin.read(length)
+            if len(data) < length:
+                break
+            records.append((kind, start, duration, argument, data))
+    return records
+
+
+class RecordingSerial:
+    """clock: where the time comes from. Defaults to the wall clock; pass lambda: ser.clock to
+    record a LoggerEmulator's simulated time instead."""
+    def __init__(self, ser, fn, clock=time.monotonic):
+        self.ser = ser
+        self.now = clock
+        self.fout = open(fn, 'wb')
+        self.fout.write(MAGIC + bytes([VERSION]))
+        self.t0 = clock()
+
+    def __getattr__(self, name):
+        # anything not recorded (port, baudrate, timeout...) goes straight to the Serial
+        return getattr(self.ser, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        if not self.fout.closed:
+            self.fout.close()
+        self.ser.close()
+
+    def log(self, kind, start, argument=-1, data=b''):
+        self.fout.write(RECORD.pack(kind, start - self.t0, self.now() - start, argument, len(data)))
+        self.fout.write(data)
+
+    def write(self, data):
+        start = self.now()
+        r = self.ser.write(data)
+        self.log(b'W', start, data=bytes(data))
+        return r
+
+    def read(self, size=1):
+        start = self.now()
+        r = self.ser.read(size)
+        self.log(b'R', start, size, r)
+        return r
+
+    def readinto(self, b):
+        start = self.now()
+        n = self.ser.readinto(b)
+        self.log(b'R', start, len(memoryview(b).cast('B')), bytes(memoryview(b).cast('B')[:n]))
+        return n
+
+    def readline(self, size=-1):
+        start = self.now()
+        r = self.ser.readline(size)
+        self.log(b'L', start, size, r)
+        return r
+
+    def reset_input_buffer(self):
+        start = self.now()
+        self.ser.reset_input_buffer()
+        self.log(b'I', start)
+
+    def reset_output_buffer(self):
+        start = self.now()
+        self.ser.reset_output_buffer()
+        self.log(b'O', start)
+
+    flushInput = reset_input_buffer
+    flushOutput = reset_output_buffer
+
+    @property
+    def in_waiting(self):
+        start = self.now()
+        n = self.ser.in_waiting
+        self.log(b'N', start, n)
+        return n
+
+
+class ReplaySerial:
+    """speed: 1 = as recorded, 10 = ten times faster, None = don't wait at all. `clock` is the
+    time the session would have taken over the recorded link (recorded waits plus the time
+    spent between calls here), whatever the speed."""
+    def __init__(self, fn, speed=1):
+        self.records = load(fn)
+        self.speed = speed
+        self.position = 0
+        self.clock = 0
+        self.last_call = time.monotonic()
+        self.timeout = 1
+        self.is_open = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        self.is_open = False
+
+    def next(self, kind, argument=None, data=None):
+        now = time.monotonic()
+        self.clock += now - self.last_call
+        if self.position >= len(self.records):
+            raise TranscriptMismatch('#{}: {} past the end of the transcript'.format(self.position, kind))
+        k, start, duration, a, d = self.records[self.position]
+        if k != kind or (argument is not None and a != argument) or (data is not None and d != data):
+            raise TranscriptMismatch('#{}: expected {} {} {}, got {} {} {}'.format(
+                                     self.position, k, a, d[:40], kind, argument, None if data is None else data[:40]))
+        self.position += 1
+        if self.speed:
+            time.sleep(duration/self.speed)
+        self.clock += duration
+        self.last_call = time.monotonic()
+        return a, d
+
+    def write(self, data):
+        self.next(b'W', data=bytes(data))
+        return len(data)
+
+    def read(self, size=1):
+        return self.next(b'R', size)[1]
+
+    def readinto(self, b):
+        m = memoryview(b).cast('B')
+        d = self.next(b'R', len(m))[1]
+        m[:len(d)] = d
+        return len(d)
+
+    def readline(self, size=-1):
+        return self.next(b'L', size)[1]
+
+    def reset_input_buffer(self):
+        self.next(b'I')
+
+    def reset_output_buffer(self):
+        self.next(b'O')
+
+    flushInput = reset_input_buffer
+    flushOutput = reset_output_buffer
+
+    @property
+    def in_waiting(self):
+        return self.next(b'N')[0]
+
+    @property
+    def done(self):
+        return self.position >= len(self.records)
+
+
+if '__main__' == __name__:
+
+    import sys
+
+    logging.basicConfig(level=logging.WARNING)
+
+    records = load(sys.argv[1])
+    for kind, start, duration, argument, data in records:
+        print('{:10.4f} {:8.1f}ms {} {:>6} {}'.format(start, duration*1e3, kind.decode(),
+                                                      argument if argument >= 0 else '',
+                                                      data if len(data) <= 60 else '{}... ({} bytes)'.format(data[:40], len(data))))
+
+    if len(records):
+        written = sum(len(r[4]) for r in records if b'W' == r[0])
+        read = sum(len(r[4]) for r in records if r[0] in [b'R', b'L'])
+        waited = sum(r[2] for r in records)
+        span = records[-1][1] + records[-1][2]
+        print('{} call(s) over {:.1f} s; {:.1f} s waiting on the port. {} byte(s) written, {} byte(s) read.'.format(
+              len(records), span, waited, written, read))
@@ -5,8 +5,7 @@
 # MESHLAB, UH Manoa
 import time, logging
 from serial import Serial
-from common import get_logger_name, get_flash_id, read_vbatt, is_logging, get_logging_config, InvalidResponseException
-from dev.set_rtc import read_rtc, ts2dt
+from common import LoggerSession, InvalidResponseException, ts2dt
 
 
 logging.basicConfig(level=logging.WARNING)
@@ -30,12 +29,14 @@ with Serial(PORT, 115200, timeout=1) as ser:
 
     while True:
         try:
-            name = get_logger_name(ser)
-            flash_id = get_flash_id(ser)
-            running = is_logging(ser)
-            vbatt = read_vbatt(ser)
-            rtc = read_rtc(ser)
-            r = get_logging_config(ser)
+            # a fresh session every time round: a different logger may have been plugged in since
+            session = LoggerSession(ser)
+            name = session.get_logger_name()
+            flash_id = session.get_flash_id()
+            running = session.is_logging()
+            vbatt = session.read_vbatt()
+            rtc = session.read_rtc()
+            r = session.get_logging_config()
             logging_start_time = r['logging_start_time']
             logging_stop_time = r['logging_stop_time']
 
@@ -0,0 +1,76 @@
+# The record of what a download has actually fetched, kept next to the .bin ("[ID].manifest").
+#
+# One JSON object per line, appended by read_memory.download() as it goes:
+#   {"begin":X,"end":Y,"crc32":Z}   flash [X,Y] is in the .bin at offset X - begin and passed CRC
+#   {"erased_from":X}               memory is empty from X onward
+# A download cut short by a bumped cable leaves a manifest that says exactly what is left to fetch.
+# A .bin without a manifest predates it, and is taken as complete.
+#
+# Here rather than in read_memory.py so that the converters can check a .bin without pyserial.
+#
+# MESHLAB, UH Manoa
+import json, logging, binascii
+from os.path import exists
+from common import SPI_FLASH_SIZE_BYTE
+
+
+def manifest_name(fn_bin):
+    return fn_bin.rsplit('.', 1)[0] + '.manifest'
+
+def load_manifest(fn_manifest, fn_bin, begin=0, verify=True):
+    """Return (verified, erased_from). verified is a sorted list of (begin, end) flash ranges
+    that are in fn_bin and still match the CRC recorded in the manifest (if verify is False,
+    that the manifest lists, without reading fn_bin)."""
+    verified = []
+    erased_from = None
+    if not exists(fn_manifest) or not exists(fn_bin):
+        return verified, erased_from
+
+    with open(fn_bin, 'rb') as fin:
+        for line in open(fn_manifest):
+            try:
+                r = json.loads(line)
+            except ValueError:
+                # most likely the last line, cut short
+                logging.debug('Ignoring manifest line: {}'.format(line))
+                continue
+            if 'erased_from' in r:
+                erased_from = r['erased_from']
+                continue
+            if not verify:
+                verified.append((r['begin'], r['end']))
+                continue
+            fin.seek(r['begin'] - begin)
+            buf = fin.read(r['end'] - r['begin'] + 1)
+            if len(buf) == r['end'] - r['begin'] + 1 and binascii.crc32(buf) == r['crc32']:
+                verified.append((r['begin'], r['end']))
+            else:
+                logging.debug('{:X} to {:X} no longer matches its CRC'.format(r['begin'], r['end']))
+    return sorted(verified), erased_from
+
+def missing_ranges(verified, begin, end):
+    """Return the gaps in [begin, end] not covered by the sorted list of ranges `verified`."""
+    gaps = []
+    for a, b in verified:
+        if a > begin:
+            gaps.append((begin, min(a - 1, end)))
+        begin = max(begin, b + 1)
+        if begin > end:
+            break
+    if begin <= end:
+        gaps.append((begin, end))
+    return gaps
+
+def is_incomplete(fn_bin, begin=0, end=SPI_FLASH_SIZE_BYTE - 1, stop_on_empty=True, verify=True):
+    """True if the manifest of fn_bin shows a download of flash [begin, end] that was started
+    but not finished (stop_on_empty: finished also means it got as far as empty memory). See
+    load_manifest() for verify."""
+    verified, erased_from = load_manifest(manifest_name(fn_bin), fn_bin, begin, verify)
+    if erased_from is not None and stop_on_empty:
+        end = min(end, erased_from - 1)
+    return len(verified) > 0 and len(missing_ranges(verified, begin, end)) > 0
+
+def check_complete(fn_bin):
+    """Refuse (RuntimeError) a .bin whose download was cut short: what it is missing is not data."""
+    if is_incomplete(fn_bin):
+        raise RuntimeError('{} is an incomplete download. Run read_memory.py again to finish it.'.format(fn_bin))
@@ -0,0 +1,110 @@
+# Pull the samples taken between two times out of the logger into a CSV file, without
+# downloading the whole memory.
+#
+# The logger takes one sample every sample interval from logging_start_time on, and writes them
+# into memory one after the other, so the sample taken at a given time is at a known address.
+# Only the pages covering the window are read: a day out of a year-long deployment is a few
+# hundred kilobytes at most instead of the full 16MB.
+#
+# The CSV is the same as what bin2csv.py makes, just the rows in the window.
+#
+# MESHLAB, UH Manoa
+import logging, sys
+from datetime import datetime
+from os import makedirs
+from os.path import join
+from serial import Serial
+from common import read_range_pipelined, AdaptiveChunkSize, get_logging_config, get_sample_count,\
+     get_flash_id, is_logging, sampleindex2flashaddress, ts2dt, TimeAxis,\
+     SPI_FLASH_PAGE_SIZE_BYTE, SAMPLE_SIZE_BYTE, SAMPLE_PER_PAGE, PIPELINE_WINDOW
+from flash_pages import sample_counts
+from sample_codec import decode_tuples
+from bin2csv import write_csv
+
+
+TIME_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d']
+
+
+def parse_time(s):
+    """datetime (UTC) from 'YYYY-MM-DD[ HH:MM[:SS]]'."""
+    for f in TIME_FORMATS:
+        try:
+            return datetime.strptime(s.strip(), f)
+        except ValueError:
+            pass
+    raise ValueError('Not a time: {}'.format(s))
+
+def extract_window(ser, start, end, config, sample_count, window=PIPELINE_WINDOW):
+    """Read the samples taken within [start, end] from the logger. Return (index of the first
+    one, list of decoded samples); the list is empty if there is nothing in the window. config
+    is what get_logging_config() returns."""
+    r = TimeAxis.from_config(config, sample_count).window(start, end)
+    if r is None:
+        return None, []
+    first, last = r
+    first_page, offset = sampleindex2flashaddress(first)
+    last_page, _ = sampleindex2flashaddress(last)
+    begin = first_page*SPI_FLASH_PAGE_SIZE_BYTE
+    end = (last_page + 1)*SPI_FLASH_PAGE_SIZE_BYTE - 1
+    logging.debug('Samples {} to {}: pages {} to {}'.format(first, last, first_page, last_page))
+
+    buf = bytearray(end - begin + 1)
+    view = memoryview(buf)
+    chunker = AdaptiveChunkSize()
+    for a, b, line in read_range_pipelined(ser, chunker.ranges(begin, end), window=window, feedback=chunker,
+                                           into=lambda a, b: view[a - begin:b - begin + 1]):
+        if len(line) <= 0:
+            raise RuntimeError('Could not read flash {:X} to {:X}'.format(a, b))
+
+    # only the last page can be short; what comes after it doesn't have the time it should
+    counts = sample_counts(buf)
+    page_count = next((k + 1 for k, n in enumerate(counts) if n < SAMPLE_PER_PAGE), len(counts))
+    D = decode_tuples(buf, 0, page_count)
+    skip = offset//SAMPLE_SIZE_BYTE
+    return first, D[skip:skip + last - first + 1]
+
+
+if '__main__' == __name__:
+
+    logging.basicConfig(level=logging.WARNING)
+
+    from common import serial_port_best_guess, save_default_port
+    DEFAULT_PORT = serial_port_best_guess(prompt=True)
+    PORT = input('PORT=? (default={}):'.format(DEFAULT_PORT)).strip()
+    # empty input, use default
+    if '' == PORT:
+        PORT = DEFAULT_PORT
+
+    with Serial(PORT, 115200, timeout=2) as ser:
+
+        save_default_port(PORT)
+
+        if is_logging(ser):
+            print('Logger is still logging. Stop it first (e.g. read_memory.py). Terminating.')
+            sys.exit()
+
+        flash_id = get_flash_id(ser)
+        config = get_logging_config(ser)
+        print('Scanning logger memory...', end='', flush=True)
+        sample_count = get_sample_count(ser, config)
+        if 0 == sample_count:
+            print(' Logger is empty. Terminating.')
+            sys.exit()
+        axis = TimeAxis.from_config(config, sample_count)
+        print(' {} sample(s) from {} to {} UTC.'.format(sample_count, ts2dt(axis.timestamp(0)), ts2dt(axis.timestamp(sample_count - 1))))
+
+        start = parse_time(input('Start (UTC, YYYY-MM-DD HH:MM:SS)? '))
+        end = parse_time(input('End (UTC, YYYY-MM-DD HH:MM:SS)? '))
+
+        first, D = extract_window(ser, start, end, config, sample_count)
+
+    if not len(D):
+        print('No sample in that window. Terminating.')
+        sys.exit()
+
+    makedirs(join('data', flash_id), exist_ok=True)
+    fn_csv = '{}_{}_{}-{}.csv'.format(flash_id, config['logging_start_time'],
+                                      start.strftime('%Y%m%d%H%M%S'), end.strftime('%Y%m%d%H%M%S'))
+    fn_csv = join('data', flash_id, fn_csv)
+    write_csv(fn_csv, D, config, first=first)
+    print('{} sample(s) written to {}'.format(len(D), fn_csv))
@@ -0,0 +1,83 @@
+# What's in a piece of logger memory: erased or not, how far it is written, how many samples
+# each page holds.
+#
+# The firmware writes 20-byte samples, 12 to a 256-byte page (the last 16 bytes of a page are
+# never used), page after page. Erased flash reads 0xff. A page ends at its first sample whose
+# temperature or pressure is NaN, and an erased sample is NaN too.
+#
+# Everything here takes bytes, bytearray, mmap or memoryview and does its scanning with
+# comparisons, rstrip() and struct (numpy for counting samples over many pages, if it's
+# installed), never byte by byte in Python: a 16MB image takes milliseconds (a fraction of a
+# second without numpy). Used by common.py (probing the logger), read_memory.py and bin2csv.py.
+#
+# MESHLAB, UH Manoa
+import struct
+from common import SPI_FLASH_PAGE_SIZE_BYTE, SAMPLE_SIZE_BYTE, SAMPLE_PER_PAGE
+
+
+# just the temperature and pressure of the 12 samples in a page
+PAGE_TP = struct.Struct('<' + 'ff{}x'.format(SAMPLE_SIZE_BYTE - 8)*SAMPLE_PER_PAGE)
+
+# blocks of 0xff to compare against, by length
+_erased = {}
+
+def erased_block(n):
+    b = _erased.get(n)
+    if b is None:
+        b = b'\xff'*n
+        if n <= 64*SPI_FLASH_PAGE_SIZE_BYTE:
+            _erased[n] = b
+    return b
+
+def is_erased(buf):
+    """True if buf is all 0xff."""
+    return buf == erased_block(len(buf))
+
+def used_length(buf):
+    """Length of buf up to and including its last byte that isn't 0xff (0 if it is all 0xff)."""
+    if isinstance(buf, bytes):
+        return len(buf.rstrip(b'\xff'))
+    # skip the erased tail a block at a time; only the last written block gets copied
+    buf = memoryview(buf).cast('B')
+    block = 64*SPI_FLASH_PAGE_SIZE_BYTE
+    end = len(buf)
+    while end > 0:
+        begin = max(0, end - block)
+        if not is_erased(buf[begin:end]):
+            return begin + len(bytes(buf[begin:end]).rstrip(b'\xff'))
+        end = begin
+    return 0
+
+def sample_count(page, offset=0):
+    """Number of samples in the page at `offset` of page (up to the first NaN one)."""
+    v = PAGE_TP.unpack_from(page, offset)
+    for k in range(SAMPLE_PER_PAGE):
+        t, p = v[2*k], v[2*k + 1]
+        if t != t or p != p:        # NaN
+            return k
+    return SAMPLE_PER_PAGE
+
+def sample_counts(buf, first=0, count=None):
+    """sample_count() of pages first, first + 1, ... (count of them; all whole pages in buf by
+    default), as a list."""
+    if count is None:
+        count = len(buf)//SPI_FLASH_PAGE_SIZE_BYTE - first
+    if count <= 0:
+        return []
+    try:
+        import numpy as np
+    except ImportError:
+        return [sample_count(buf, k*SPI_FLASH_PAGE_SIZE_BYTE) for k in range(first, first + count)]
+    # T and P as raw float32 bits: a NaN has all exponent bits set and a non-zero mantissa
+    a = np.frombuffer(buf, dtype='<u4', count=count*SPI_FLASH_PAGE_SIZE_BYTE//4, offset=first*SPI_FLASH_PAGE_SIZE_BYTE)
+    a = a.reshape(count, SPI_FLASH_PAGE_SIZE_BYTE//4)[:, :SAMPLE_PER_PAGE*SAMPLE_SIZE_BYTE//4]
+    tp = a.reshape(count, SAMPLE_PER_PAGE, SAMPLE_SIZE_BYTE//4)[:, :, :2]
+    nan = ((tp & 0x7f800000) == 0x7f800000) & ((tp & 0x007fffff) != 0)
+    nan = nan.any(axis=2)
+    return np.where(nan.any(axis=1), nan.argmax(axis=1), SAMPLE_PER_PAGE).tolist()
+
+def count_samples(buf):
+    """Number of samples in buf, the way the .bin decoder counts them (page by page, each up to
+    its first NaN sample)."""
+    used = -(-used_length(buf)//SPI_FLASH_PAGE_SIZE_BYTE)
+    return sum(sample_counts(buf, 0, min(used, len(buf)//SPI_FLASH_PAGE_SIZE_BYTE)))
@@ -0,0 +1,100 @@
+# What the serial link has been up to: per-command latency histograms, retries, CRC failures,
+# short reads, timeouts and bytes each way.
+#
+# The helpers in common.py record every exchange into METRICS. Look at it directly, save it as
+# JSON, or as a Prometheus textfile (for node_exporter's textfile collector) to graph link
+# health over time. read_memory.py does both when told to (METRICS_JSON, METRICS_PROMETHEUS).
+#
+# MESHLAB, UH Manoa
+import json, time, threading
+from os import replace
+
+
+# latency histogram bucket upper bounds, in second
+BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10]
+# the counters kept for every command
+COUNTERS = ['exchanges', 'retries', 'crc_failures', 'short_reads', 'timeouts', 'bytes_sent', 'bytes_received']
+
+
+class LinkMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.starttime = time.time()
+            self.commands = {}
+
+    def _get(self, name):
+        c = self.commands.get(name)
+        if c is None:
+            c = {k: 0 for k in COUNTERS}
+            c['latency_sum'] = 0
+            c['latency_buckets'] = [0]*(len(BUCKETS) + 1)      # the last one is +Inf
+            self.commands[name] = c
+        return c
+
+    def count(self, name, counter, n=1):
+        with self.lock:
+            self._get(name)[counter] += n
+
+    def exchange(self, name, latency, received=0):
+        """A response (or the lack of one) to command `name`, `latency` second after it was sent."""
+        with self.lock:
+            c = self._get(name)
+            c['exchanges'] += 1
+            c['bytes_received'] += received
+            c['latency_sum'] += latency
+            i = 0
+            while i < len(BUCKETS) and latency > BUCKETS[i]:
+                i += 1
+            c['latency_buckets'][i] += 1
+
+    def total(self, counter):
+        with self.lock:
+            return sum(c[counter] for c in self.commands.values())
+
+    def to_dict(self):
+        with self.lock:
+            return {'since': self.starttime,
+                    'buckets': BUCKETS,
+                    'commands': json.loads(json.dumps(self.commands))}
+
+    def save_json(self, fn):
+        with open(fn, 'w') as fout:
+            json.dump(self.to_dict(), fout, indent=2)
+
+    def save_prometheus(self, fn, labels=None):
+        """Write the Prometheus text format. The file is replaced in one go so that the
+        collector never sees half of it."""
+        d = self.to_dict()
+        extra = ''.join(',{}="{}"'.format(k, v) for k, v in sorted((labels or {}).items()))
+        L = []
+        L.append('# HELP huliwai_command_latency_seconds Time from command to response.')
+        L.append('# TYPE huliwai_command_latency_seconds histogram')
+        for name, c in sorted(d['commands'].items()):
+            n = 0
+            for le, k in zip([str(b) for b in BUCKETS] + ['+Inf'], c['latency_buckets']):
+                n += k
+                L.append('huliwai_command_latency_seconds_bucket{{command="{}"{},le="{}"}} {}'.format(name, extra, le, n))
+            L.append('huliwai_command_latency_seconds_sum{{command="{}"{}}} {}'.format(name, extra, c['latency_sum']))
+            L.append('huliwai_command_latency_seconds_count{{command="{}"{}}} {}'.format(name, extra, c['exchanges']))
+        for counter in COUNTERS[1:]:
+            L.append('# TYPE huliwai_{}_total counter'.format(counter))
+            for name, c in sorted(d['commands'].items()):
+                L.append('huliwai_{}_total{{command="{}"{}}} {}'.format(counter, name, extra, c[counter]))
+
+        with open(fn + '.tmp', 'w') as fout:
+            fout.write('\n'.join(L) + '\n')
+        replace(fn + '.tmp', fn)
+
+    def summary(self):
+        """One line, for humans."""
+        with self.lock:
+            C = self.commands.values()
+            return '{} exchange(s), {} retries, {} CRC failure(s), {} short read(s), {} timeout(s); {} byte(s) sent, {} received'.format(
+                   *[sum(c[k] for c in C) for k in COUNTERS])
+
+
+METRICS = LinkMetrics()
@@ -8,7 +8,7 @@ from os.path import join, exists
 import matplotlib.pyplot as plt
 from matplotlib.dates import DateFormatter
 from bin2csv import find
-from common import ts2dt, dt2ts
+from common import ts2dt, dt2ts, ts2datetime64
 
 
 def get_logger_name(fn):
@@ -23,7 +23,15 @@ def get_logger_name(fn):
 
 
 def read_and_parse_data(fn):
-    
+    # the columnar copy bin2csv.py makes of the same data loads without parsing (as long as it
+    # was made from the .bin as it is now; file times don't survive a copy)
+    fn_columns = fn.rsplit('.', 1)[0] + '.columns'
+    from columnar import is_current, load
+    if fn.endswith('.csv') and is_current(fn_columns, fn.rsplit('.', 1)[0] + '.bin'):
+        logging.debug('Using {}'.format(fn_columns))
+        columns, time_axis, _ = load(fn_columns)
+        return [time_axis.timestamps()] + list(columns.values())
+
     # Cory wants a human time column
     line = open(fn).readline().split(',')
     has_human_time = 10 == len(line)
@@ -108,7 +116,7 @@ if '__main__' == __name__:
     #print('Step sizes: ', end='')
     #print(sorted(np.unique(tmp)))
 
-    dt = [ts2dt(tmp) for tmp in ts]
+    dt = ts2datetime64(ts)
 
     print('Plotting time series...')
     plt.figure(figsize=(16, 9))
@@ -3,15 +3,19 @@
 # Stanley H.I. Lio
 # hlio@hawaii.edu
 # MESHLAB, UH Manoa
-import time, logging, sys, json
+import time, logging, sys, json, binascii
+from itertools import chain
 from os import makedirs
-from os.path import join, exists
+from os.path import join, exists, getsize
 from serial import Serial
 from serial.serialutil import SerialException
 from common import SPI_FLASH_SIZE_BYTE, SPI_FLASH_PAGE_SIZE_BYTE, SAMPLE_INTERVAL_CODE_MAP,\
-     is_logging, stop_logging, get_logging_config, read_vbatt, get_logger_name, get_flash_id, read_range_core,\
-     InvalidResponseException
-from bin2csv import bin2csv
+     read_range_core, read_range_pipelined, AdaptiveChunkSize, LoggerSession, InvalidResponseException
+from link_metrics import METRICS
+from flash_pages import is_erased, used_length
+from download_manifest import manifest_name, load_manifest, missing_ranges
+import download_manifest
+from bin2csv import bin2csv_sharded, export_columnar
 
 
 logging.basicConfig(level=logging.WARNING)
@@ -24,17 +28,194 @@ END = SPI_FLASH_SIZE_BYTE - 1
 # Request this many bytes each time
 # The response will be 4-byte longer (CRC32 at the end of the response)
 CHUNK_SIZE = 16*SPI_FLASH_PAGE_SIZE_BYTE
+# Let CHUNK_SIZE float with the link quality: grow it while responses pass CRC, shrink it on errors
+ADAPTIVE_CHUNK_SIZE = True
+# Keep this many requests in flight instead of waiting out a round trip per chunk. 1 = one at a time.
+PIPELINE_WINDOW = 4
 # Stop reading if the response is all empty (0xff for NOR flash)
 STOP_ON_EMPTY = True
+# Before fetching only the new data for an existing .bin, check this many of its last pages against the logger
+INCREMENTAL_CHECK_PAGES = 4
+# Record everything said over the serial port to this file (see dev/transcript.py). None = don't.
+TRANSCRIPT = None
+# Save the link metrics (latencies, retries, CRC failures...; see link_metrics.py) of each download
+# as JSON and/or as a Prometheus textfile. None = don't.
+METRICS_JSON = None
+METRICS_PROMETHEUS = None
 
 
 def split_range(begin, end, pkt_size):
     assert end >= begin
-    A = tuple(range(begin, end, pkt_size))
-    B = [x + pkt_size - 1 for x in A]
+    A = tuple(range(begin, end + 1, pkt_size))
+    B = [min(x + pkt_size - 1, end) for x in A]
     return list(zip(A, B))
 
 
+def download(ser, fn_bin, begin=BEGIN, end=END, resume=False, verbose=True, used=None, policy=None):
+    """Read flash [begin, end] into fn_bin, logging each CRC-verified chunk in a manifest next to it
+    (see download_manifest.py). Only verified data ever goes into fn_bin.
+    If resume is True, trust whatever the manifest says is already in fn_bin and fetch only the rest.
+    Set verbose to False to keep quiet about progress. `used` is how much of the flash the logger
+    says it has written (in byte), if known; it only makes the ETA better. `policy` is the
+    RetryPolicy to read with (DEFAULT_RETRY_POLICY if not given).
+    Return the AdaptiveChunkSize used (None if ADAPTIVE_CHUNK_SIZE is off)."""
+    fn_manifest = manifest_name(fn_bin)
+
+    gaps = [(begin, end)]
+    if resume:
+        verified, erased_from = load_manifest(fn_manifest, fn_bin, begin)
+        if STOP_ON_EMPTY and erased_from is not None:
+            end = min(end, erased_from - 1)
+        gaps = missing_ranges(verified, begin, end)
+        if len(verified) and verbose:
+            print('Resuming: {} byte(s) already downloaded.'.format(sum(b - a + 1 for a, b in verified)))
+    resume = resume and exists(fn_bin)
+
+    if ADAPTIVE_CHUNK_SIZE:
+        chunker = AdaptiveChunkSize(initial=CHUNK_SIZE)
+        ranges = chain.from_iterable(chunker.ranges(a, b) for a, b in gaps)
+    else:
+        chunker = None
+        ranges = chain.from_iterable(split_range(a, b, CHUNK_SIZE) for a, b in gaps)
+
+    # what there is to fetch, for the progress line
+    last = end if used is None or not STOP_ON_EMPTY else min(end, max(used - 1, begin))
+    total = sum(min(b, last) - a + 1 for a, b in gaps if a <= last)
+    fetched = 0
+    starttime = time.time()
+
+    # Each response is read straight into a buffer of its own (CRC checked in place, no copy to
+    # strip it) and written to its place in the .bin only once it has passed. The file only ever
+    # grows by what was written: an interrupted download leaves nothing in it that wasn't
+    # verified, and the manifest says which parts those are.
+    size = end - begin + 1
+    if size <= 0 or not len(gaps):
+        return chunker      # nothing left to fetch
+    with open(fn_bin, 'r+b' if resume else 'w+b') as fout,\
+         open(fn_manifest, 'a' if resume else 'w') as fmanifest:
+        extent = fout.seek(0, 2)    # how much of the file is worth keeping
+        reader = read_range_pipelined(ser, ranges, window=PIPELINE_WINDOW, feedback=chunker, policy=policy,
+                                      into=lambda a, b: bytearray(b - a + 1))
+        try:
+            for a, b, line in reader:
+                if len(line) <= 0:
+                    raise RuntimeError('wut?')
+                fetched += len(line)
+                if verbose:
+                    print('\r' + progress(a, b, min(fetched, total), total, time.time() - starttime), end='', flush=True)
+                if STOP_ON_EMPTY and is_erased(line):
+                    if verbose:
+                        print()
+                        print('Reached empty section in memory. Terminating.')
+                    extent = min(extent, a - begin)
+                    fmanifest.write(json.dumps({'erased_from': a}, separators=(',', ':')) + '\n')
+                    break
+                fout.seek(a - begin)
+                fout.write(line)
+                extent = max(extent, b - begin + 1)
+                fmanifest.write(json.dumps({'begin': a, 'end': b, 'crc32': binascii.crc32(line)}, separators=(',', ':')) + '\n')
+                fmanifest.flush()
+        finally:
+            reader.close()
+            # a resumed .bin may run past where memory turned out to be empty
+            fout.truncate(extent)
+    if verbose:
+        print()
+    return chunker
+
+def progress(a, b, fetched, total, elapsed):
+    """One status line: where we are, how fast, how long to go, and how the link is doing."""
+    rate = fetched/elapsed if elapsed > 0 else 0
+    eta = (total - fetched)/rate if rate > 0 else 0
+    return '{:X}-{:X}: {:.2f}/{:.2f} MB ({:.0f}%), {:.1f} kB/s, ETA {:d}:{:02d}, {} retries, {} CRC failure(s)  '.format(
+           a, b, fetched/1024/1024, total/1024/1024, fetched/total*100 if total > 0 else 100, rate/1e3,
+           int(eta)//60, int(eta)%60, METRICS.total('retries'), METRICS.total('crc_failures'))
+
+def is_incomplete(fn_bin):
+    """True if the manifest of fn_bin shows a download that was started but not finished."""
+    return download_manifest.is_incomplete(fn_bin, BEGIN, END, STOP_ON_EMPTY)
+
+def prepare_incremental(ser, fn_bin):
+    """Get an existing fn_bin ready for fetching only what the logger has recorded since.
+    Check the last few pages of fn_bin against the logger, then rewrite the manifest so that
+    download(resume=True) picks up right after them. A trailing page that was only partly
+    written last time is fetched again. Return the flash address the download will resume
+    at, or None if fn_bin doesn't match what is in the logger."""
+    fn_manifest = manifest_name(fn_bin)
+    verified, _ = load_manifest(fn_manifest, fn_bin)
+    if len(verified):
+        gaps = missing_ranges(verified, BEGIN, END)
+        extent = gaps[0][0] if len(gaps) else END + 1
+    else:
+        extent = BEGIN + getsize(fn_bin)
+    # the last chunk may well be padded with empty pages. Those don't count.
+    with open(fn_bin, 'rb') as fin:
+        used = used_length(fin.read(extent - BEGIN))
+    extent = BEGIN + -(-used//SPI_FLASH_PAGE_SIZE_BYTE)*SPI_FLASH_PAGE_SIZE_BYTE
+
+    check_begin = max(BEGIN, extent - INCREMENTAL_CHECK_PAGES*SPI_FLASH_PAGE_SIZE_BYTE)
+    if check_begin < extent:
+        theirs = read_range_core(ser, check_begin, extent - 1)
+        if len(theirs) != extent - check_begin:
+            raise InvalidResponseException('Cannot read logger memory')
+        with open(fn_bin, 'rb') as fin:
+            fin.seek(check_begin - BEGIN)
+            ours = fin.read(extent - check_begin)
+        for k in range(0, len(ours), SPI_FLASH_PAGE_SIZE_BYTE):
+            a = ours[k:k + SPI_FLASH_PAGE_SIZE_BYTE]
+            b = theirs[k:k + SPI_FLASH_PAGE_SIZE_BYTE]
+            if a == b:
+                continue
+            # not a match, but fine if the logger has only added to a page that was partly written back then
+            used = a[:used_length(a)]
+            if len(used) < len(a) and b.startswith(used):
+                extent = check_begin + k
+                break
+            logging.debug('Page at {:X} differs'.format(check_begin + k))
+            return None
+
+    with open(fn_bin, 'rb') as fin, open(fn_manifest, 'w') as fmanifest:
+        for a, b in split_range(BEGIN, extent - 1, CHUNK_SIZE) if extent > BEGIN else []:
+            fin.seek(a - BEGIN)
+            fmanifest.write(json.dumps({'begin': a, 'end': b, 'crc32': binascii.crc32(fin.read(b - a + 1))}, separators=(',', ':')) + '\n')
+    return extent
+
+
+def save_config(session, stop_logging_time=None):
+    """Update (or create) the .config file of the logger's current logging session. Return the config.
+    session is a LoggerSession."""
+    flash_id = session.get_flash_id()
+    logger_name = session.get_logger_name()
+    makedirs(join('data', flash_id), exist_ok=True)
+
+    # An existing .config file is not required to generate the final CSV, but there are
+    # a few things like vbatt_pre that I want to preserve if it's there.
+    metadata = session.get_logging_config()
+    logging.debug(metadata)
+
+    configfilename = '{}_{}.config'.format(flash_id, metadata['logging_start_time'])
+    configfilename = join('data', flash_id, configfilename)
+    config = {}
+    if exists(configfilename):
+        config = json.loads(open(configfilename).read())
+    else:
+        logging.warning('No existing config file.')
+    config['logger_name'] = logger_name
+    config['flash_id'] = flash_id
+    config['logging_start_time'] = metadata['logging_start_time']
+    config['logging_stop_time'] = metadata['logging_stop_time']
+    config['logging_interval_code'] = metadata['logging_interval_code']
+    if stop_logging_time is not None:
+        config['stop_logging_time'] = stop_logging_time
+    else:
+        if 'stop_logging_time' in config:
+            del config['stop_logging_time']     # remove old record if any
+    config['vbatt_post'] = session.read_vbatt()
+    logging.debug(config)
+    open(configfilename, 'w').write(json.dumps(config, separators=(',', ':')))
+    return config
+
+
 if '__main__' == __name__:
 
     # find the serial port to use from user, from history, or make a guess
@@ -47,20 +228,26 @@ if '__main__' == __name__:
     if '' == PORT:
         PORT = DEFAULT_PORT
 
-    with Serial(PORT, 115200, timeout=2) as ser:
+    ser = Serial(PORT, 115200, timeout=2)
+    if TRANSCRIPT is not None:
+        from dev.transcript import RecordingSerial
+        ser = RecordingSerial(ser, TRANSCRIPT)
+
+    with ser:
 
         save_default_port(PORT)
 
         ser.reset_input_buffer()
         ser.reset_output_buffer()
         ser.write(b'\n\n\n')
+        session = LoggerSession(ser)
 
         stop_logging_time = None
 
-        if is_logging(ser):
+        if session.is_logging():
             r = input('Logger is still logging. Stop logging? (yes/no; default=no)')
             if r.strip().lower() == 'yes':
-                if not stop_logging(ser):
+                if not session.stop_logging():
                     print('Could not stop logger. Terminating.')
                     sys.exit()
 
@@ -70,70 +257,68 @@ if '__main__' == __name__:
                 sys.exit()
 
         try:
-            logger_name = get_logger_name(ser)
+            logger_name = session.get_logger_name()
             print('Name: {}'.format(logger_name))
-            flash_id = get_flash_id(ser)
+            flash_id = session.get_flash_id()
             print('ID: {}'.format(flash_id))
         except InvalidResponseException:
             print('Cannot read logger name/ID. Terminating.')
             sys.exit()
 
-        makedirs(join('data', flash_id), exist_ok=True)
-
-        # An existing .config file is not required to generate the final CSV, but there are
-        # a few things like vbatt_pre that I want to preserve if it's there.
-        metadata = get_logging_config(ser)
-        logging.debug(metadata)
-
-        configfilename = '{}_{}.config'.format(flash_id, metadata['logging_start_time'])
-        configfilename = join('data', flash_id, configfilename)
-        config = {}
-        if exists(configfilename):
-            config = json.loads(open(configfilename).read())
-        else:
-            logging.warning('No existing config file.')
-        config['logger_name'] = logger_name
-        config['flash_id'] = flash_id
-        config['logging_start_time'] = metadata['logging_start_time']
-        config['logging_stop_time'] = metadata['logging_stop_time']
-        config['logging_interval_code'] = metadata['logging_interval_code']
-        if stop_logging_time is not None:
-            config['stop_logging_time'] = stop_logging_time
-        else:
-            if 'stop_logging_time' in config:
-                del config['stop_logging_time']     # remove old record if any
-        config['vbatt_post'] = read_vbatt(ser)
-        logging.debug(config)
-        open(configfilename, 'w').write(json.dumps(config, separators=(',', ':')))
+        config = save_config(session, stop_logging_time)
 
         print('Sample interval = {} second'.format(SAMPLE_INTERVAL_CODE_MAP[config['logging_interval_code']]))
 
-        fn_bin = '{}_{}.bin'.format(flash_id, metadata['logging_start_time'])
+        fn_bin = '{}_{}.bin'.format(flash_id, config['logging_start_time'])
         fn_bin = join('data', flash_id, fn_bin)
+        resume = False
+        incremental = False
         if exists(fn_bin):
-            r = input(fn_bin + ' already exists. Overwrite? (yes/no; default=no)')
-            if r.strip().lower() != 'yes':
-                print('No change made. Terminating.')
-                sys.exit()
+            if is_incomplete(fn_bin):
+                r = input(fn_bin + ' is incomplete. Resume? (yes/no; default=yes)')
+                resume = r.strip().lower() in ['', 'yes']
+            else:
+                r = input(fn_bin + ' already exists. Download only data recorded since? (yes/no; default=yes)')
+                if r.strip().lower() in ['', 'yes']:
+                    extent = prepare_incremental(ser, fn_bin)
+                    if extent is None:
+                        print(fn_bin + ' does not match what is in the logger.')
+                    else:
+                        print('Continuing from {:X}.'.format(extent))
+                        resume = incremental = True
+            if not resume:
+                r = input(fn_bin + ' already exists. Overwrite? (yes/no; default=no)')
+                if r.strip().lower() != 'yes':
+                    print('No change made. Terminating.')
+                    sys.exit()
 
         starttime = time.time()
-        with open(fn_bin, 'wb') as fout:
-            for begin, end in split_range(BEGIN, END, CHUNK_SIZE):
-                print('Reading {:X} to {:X} ({:.2f}% of total capacity)'.format(begin, end, end/SPI_FLASH_SIZE_BYTE*100))
-                line = read_range_core(ser, begin, end)
-                if len(line) <= 0:
-                    raise RuntimeError('wut?')
-                if STOP_ON_EMPTY and all([0xFF == b for b in line]):
-                    print('Reached empty section in memory. Terminating.')
-                    break
-                fout.write(line)
+        try:
+            metadata = session.get_logging_config()
+            used = (metadata['current_page_addr'] + 1)*SPI_FLASH_PAGE_SIZE_BYTE if 'current_page_addr' in metadata else None
+            chunker = download(ser, fn_bin, resume=resume, used=used)
+        except (SerialException, InvalidResponseException, RuntimeError):
+            logging.exception('')
+            print('Download interrupted. Run this again to resume where it left off.')
+            sys.exit()
         endtime = time.time()
 
     # - - - - -
     fn_csv = fn_bin.rsplit('.')[0] + '.csv'
-    bin2csv(fn_bin, fn_csv, config)
+    bin2csv_sharded(fn_bin, fn_csv, config, append=incremental)
     print('Output CSV file: {}'.format(fn_csv))
+    fn_columns = export_columnar(fn_bin, config)
+    if fn_columns is not None:
+        print('Output columnar file: {}'.format(fn_columns))
     print('Output binary file: {}'.format(fn_bin))
     print('Took {:.1f} minutes.'.format((endtime - starttime)/60))
+    print('Link: {}.'.format(METRICS.summary()))
+    if METRICS_JSON is not None:
+        METRICS.save_json(METRICS_JSON)
+    if METRICS_PROMETHEUS is not None:
+        METRICS.save_prometheus(METRICS_PROMETHEUS, labels={'logger': flash_id})
+    if chunker is not None:
+        print('Chunk size settled at {} bytes ({:.0f} byte/s; {:.0f} byte/s overall, {} failed response(s)).'.format(
+            chunker.size, chunker.throughput(chunker.size), chunker.throughput(), chunker.failure_count))
     print('Save/copy this, you will need it if you want to run plot_csv.py: {}'.format(flash_id))
     
@@ -0,0 +1,127 @@
+# Download every logger attached to this computer at once.
+#
+# Each serial port gets its own download thread; each finished .bin is converted to CSV (and to a
+# columnar file, see bin2csv.EXPORT_COLUMNAR) in a separate pool of processes while the other
+# downloads carry on. Files go where read_memory.py puts them (data/<flash_id>/). Existing
+# downloads are resumed, or topped up with whatever was recorded since; a .bin that doesn't match
+# its logger is left alone (use read_memory.py).
+#
+# MESHLAB, UH Manoa
+import time, logging, sys
+from os.path import join, exists
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from serial import Serial
+from serial.serialutil import SerialException
+from common import get_flash_id, LoggerSession, InvalidResponseException
+from read_memory import save_config, download, is_incomplete, prepare_incremental
+from bin2csv import bin2csv, export_columnar, CONVERSION_WORKERS
+
+
+logging.basicConfig(level=logging.WARNING)
+
+
+def find_loggers(ports):
+    """Return {port: flash_id} for those ports with a logger on them."""
+    def probe(port):
+        try:
+            with Serial(port, 115200, timeout=1) as ser:
+                return get_flash_id(ser, maxretry=3)
+        except (SerialException, InvalidResponseException, OSError):
+            logging.debug('Nothing on {}'.format(port))
+        return None
+
+    with ThreadPoolExecutor(max_workers=max(len(ports), 1)) as pool:
+        found = dict(zip(ports, pool.map(probe, ports)))
+    return {port: flash_id for port, flash_id in found.items() if flash_id is not None}
+
+def fetch(port, stop=False):
+    """Download the logger on the given port. Return (fn_bin, config, incremental), or None if
+    there is nothing to do. Meant to run in its own thread, one per port."""
+    with Serial(port, 115200, timeout=2) as ser:
+        ser.reset_input_buffer()
+        ser.reset_output_buffer()
+        ser.write(b'\n\n\n')
+        session = LoggerSession(ser)
+
+        flash_id = session.get_flash_id()
+        stop_logging_time = None
+        if session.is_logging():
+            if not stop:
+                print('{} ({}) is still logging. Skipped.'.format(flash_id, port))
+                return None
+            if not session.stop_logging():
+                print('{} ({}): could not stop logger. Skipped.'.format(flash_id, port))
+                return None
+            stop_logging_time = time.time()
+
+        logger_name = session.get_logger_name()
+        config = save_config(session, stop_logging_time)
+
+        fn_bin = '{}_{}.bin'.format(flash_id, config['logging_start_time'])
+        fn_bin = join('data', flash_id, fn_bin)
+        resume = False
+        incremental = False
+        if exists(fn_bin):
+            resume = is_incomplete(fn_bin)
+            if not resume:
+                if prepare_incremental(ser, fn_bin) is None:
+                    print('{} ({}): {} does not match what is in the logger. Skipped.'.format(flash_id, port, fn_bin))
+                    return None
+                resume = incremental = True
+
+        print('{} ({}) "{}": downloading...'.format(flash_id, port, logger_name))
+        download(ser, fn_bin, resume=resume, verbose=False)
+        return fn_bin, config, incremental
+
+def convert(fn_bin, config, incremental):
+    """Make the CSV (and columnar file) of a downloaded .bin. Return the CSV's name. Runs in a
+    worker process."""
+    fn_csv = fn_bin.rsplit('.')[0] + '.csv'
+    bin2csv(fn_bin, fn_csv, config, append=incremental)
+    export_columnar(fn_bin, config)
+    return fn_csv
+
+
+if '__main__' == __name__:
+
+    import serial.tools.list_ports
+
+    ports = sorted(c.device for c in serial.tools.list_ports.comports())
+    print('Looking for loggers on {} port(s)...'.format(len(ports)))
+    loggers = find_loggers(ports)
+    if not len(loggers):
+        print('No logger found. Terminating.')
+        sys.exit()
+    for port, flash_id in sorted(loggers.items()):
+        print('  {}\t{}'.format(port, flash_id))
+
+    r = input('Stop loggers that are still logging? (yes/no; default=no)')
+    stop = r.strip().lower() == 'yes'
+
+    starttime = time.time()
+    with ThreadPoolExecutor(max_workers=len(loggers)) as downloaders,\
+         ProcessPoolExecutor(max_workers=CONVERSION_WORKERS) as converters:
+
+        F = {downloaders.submit(fetch, port, stop): port for port in loggers}
+        C = {}
+        for f in as_completed(F):
+            port = F[f]
+            try:
+                r = f.result()
+            except (SerialException, InvalidResponseException, RuntimeError, OSError):
+                logging.exception(port)
+                print('{} ({}): download interrupted. Run this again to resume where it left off.'.format(loggers[port], port))
+                continue
+            if r is None:
+                continue
+            fn_bin, config, incremental = r
+            print('{} ({}): downloaded in {:.1f} minutes. Converting...'.format(loggers[port], port, (time.time() - starttime)/60))
+            C[converters.submit(convert, fn_bin, config, incremental)] = fn_bin
+
+        for f in as_completed(C):
+            try:
+                print('Output CSV file: {}'.format(f.result()))
+            except Exception:
+                logging.exception(C[f])
+
+    print('Took {:.1f} minutes.'.format((time.time() - starttime)/60))
@@ -0,0 +1,78 @@
+# Decode the logger's 20-byte samples.
+#
+# A sample is T (float32, Deg.C), P (float32, kPa), then ambient light, white light, red, green,
+# blue and white (uint16 each), little-endian. A 256-byte page holds 12 of them followed by 16
+# unused bytes, and ends at its first sample whose T or P is NaN (see flash_pages.py).
+#
+# decode() views whole pages as a numpy structured array and picks out the samples with a mask
+# computed over all pages at once: a full 16MB image decodes in well under a second, against
+# tens of seconds sample by sample. decode_tuples() gives the same samples as a list of tuples,
+# with or without numpy. SAMPLE decodes one sample at a time (sparse_read.py).
+#
+# MESHLAB, UH Manoa
+import struct
+from common import SPI_FLASH_PAGE_SIZE_BYTE, SAMPLE_SIZE_BYTE, SAMPLE_PER_PAGE
+from flash_pages import sample_count
+
+
+SAMPLE = struct.Struct('<ffHHHHHH')
+# the sample fields, named as in the CSV header
+FIELDS = ['T_DegC', 'P_kPa', 'ambient_light_hdr', 'white_light_hdr', 'red', 'green', 'blue', 'white']
+
+_dtype = {}
+
+def sample_dtype():
+    """numpy dtype of one sample."""
+    if 'sample' not in _dtype:
+        import numpy as np
+        _dtype['sample'] = np.dtype([(f, '<f4' if k < 2 else '<u2') for k, f in enumerate(FIELDS)])
+        assert SAMPLE_SIZE_BYTE == _dtype['sample'].itemsize
+    return _dtype['sample']
+
+def page_dtype():
+    """numpy dtype of one page: 'samples' (12 of sample_dtype()) and the unused tail."""
+    if 'page' not in _dtype:
+        import numpy as np
+        _dtype['page'] = np.dtype([('samples', sample_dtype(), (SAMPLE_PER_PAGE,)),
+                                   ('unused', 'V{}'.format(SPI_FLASH_PAGE_SIZE_BYTE - SAMPLE_PER_PAGE*SAMPLE_SIZE_BYTE))])
+        assert SPI_FLASH_PAGE_SIZE_BYTE == _dtype['page'].itemsize
+    return _dtype['page']
+
+def page_count(buf, first=0, count=None):
+    if count is None:
+        count = len(buf)//SPI_FLASH_PAGE_SIZE_BYTE - first
+    return max(count, 0)
+
+def pages(buf, first=0, count=None):
+    """Pages first, first + 1, ... (count of them; all whole pages in buf by default) of buf as
+    a (page, 12) structured array of samples. A view, nothing is copied."""
+    import numpy as np
+    count = page_count(buf, first, count)
+    return np.frombuffer(buf, dtype=page_dtype(), count=count, offset=first*SPI_FLASH_PAGE_SIZE_BYTE)['samples']
+
+def valid_mask(p):
+    """(page, 12) boolean array, True for the samples of pages p (from pages()) that come before
+    the first NaN one of their page."""
+    import numpy as np
+    nan = np.isnan(p['T_DegC']) | np.isnan(p['P_kPa'])
+    return ~np.logical_or.accumulate(nan, axis=1)
+
+def decode(buf, first=0, count=None):
+    """The samples in pages first, first + 1, ... of buf, in order, as a structured array;
+    a['T_DegC'] etc. are the columns. Needs numpy."""
+    p = pages(buf, first, count)
+    return p[valid_mask(p)]
+
+def decode_tuples(buf, first=0, count=None):
+    """Same as decode(), as a list of (T, P, als, white_light, r, g, b, w) tuples. Works
+    without numpy too."""
+    try:
+        import numpy
+    except ImportError:
+        D = []
+        for k in range(first, first + page_count(buf, first, count)):
+            a = k*SPI_FLASH_PAGE_SIZE_BYTE
+            n = sample_count(buf, a)
+            D.extend(SAMPLE.iter_unpack(memoryview(buf)[a:a + n*SAMPLE_SIZE_BYTE]))
+        return D
+    return decode(buf, first, count).tolist()
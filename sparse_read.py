@@ -0,0 +1,54 @@
+# Read scattered samples out of the logger with as few requests as it makes sense to.
+#
+# Every request costs about as much as REQUEST_OVERHEAD_BYTE bytes of transfer on top of what
+# it reads (the command itself, the CRC, the logger getting around to it), so two samples
+# closer than that are cheaper to read with one request that spans the gap between them than
+# with two. plan() works out the byte ranges; read_samples() reads and decodes them.
+#
+# MESHLAB, UH Manoa
+import logging
+from common import read_range_pipelined, SPI_FLASH_PAGE_SIZE_BYTE, SAMPLE_SIZE_BYTE, SAMPLE_PER_PAGE, PIPELINE_WINDOW
+from sample_codec import SAMPLE
+
+
+# what one more request costs, in bytes of transfer: the command, the CRC and the logger's
+# turnaround, the latter mostly hidden by keeping several requests in flight
+REQUEST_OVERHEAD_BYTE = 128
+# never ask for more than this in one go (a CRC failure costs the whole request)
+MAX_REQUEST_BYTE = 64*SPI_FLASH_PAGE_SIZE_BYTE
+
+def sample_address(sample_index):
+    """Flash byte address of the given sample."""
+    page, k = divmod(sample_index, SAMPLE_PER_PAGE)
+    return page*SPI_FLASH_PAGE_SIZE_BYTE + k*SAMPLE_SIZE_BYTE
+
+def plan(sample_indices, overhead=REQUEST_OVERHEAD_BYTE, max_request=MAX_REQUEST_BYTE):
+    """Return the (begin, end) byte ranges to read to get the given samples: each sample on its
+    own, except where reading across the gap to the next one costs less than another request."""
+    ranges = []
+    for a in sorted(set(sample_address(i) for i in sample_indices)):
+        b = a + SAMPLE_SIZE_BYTE - 1
+        if len(ranges):
+            begin, end = ranges[-1]
+            if a - end - 1 <= overhead and b - begin + 1 <= max_request:
+                ranges[-1] = (begin, b)
+                continue
+        ranges.append((a, b))
+    return ranges
+
+def read_samples(ser, sample_indices, overhead=REQUEST_OVERHEAD_BYTE, window=PIPELINE_WINDOW):
+    """Read the given samples. Yield (sample index, decoded sample) as they come in, in address
+    order. Samples in a range that couldn't be read are left out."""
+    ranges = plan(sample_indices, overhead)
+    logging.debug('{} sample(s) in {} request(s), {} byte(s)'.format(len(sample_indices), len(ranges),
+                                                                     sum(end - begin + 1 for begin, end in ranges)))
+    wanted = sorted(set(sample_indices), key=sample_address)
+    k = 0
+    for begin, end, data in read_range_pipelined(ser, ranges, window=window):
+        while k < len(wanted) and sample_address(wanted[k]) <= end:
+            i = wanted[k]
+            k += 1
+            if len(data):
+                yield i, SAMPLE.unpack_from(data, sample_address(i) - begin)
+            else:
+                logging.warning('Could not read sample {}'.format(i))
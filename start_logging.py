@@ -19,7 +19,7 @@ from os.path import join, exists
 from serial import Serial
 from serial.serialutil import SerialException
 from dev.set_rtc import set_rtc_aligned, read_rtc, ts2dt
-from common import is_logging, stop_logging, find_last_used_page, get_logging_config, read_vbatt, get_flash_id, get_logger_name, InvalidResponseException, SAMPLE_INTERVAL_CODE_MAP
+from common import LoggerSession, find_last_used_page, InvalidResponseException, SAMPLE_INTERVAL_CODE_MAP
 
 
 logging.basicConfig(level=logging.WARNING)
@@ -40,10 +40,12 @@ if '' == PORT:
 
 with Serial(PORT, 115200, timeout=1) as ser:
 
+    session = LoggerSession(ser)
+
     try:
-        logger_name = get_logger_name(ser)
-        flash_id = get_flash_id(ser)
-        vbatt = read_vbatt(ser)
+        logger_name = session.get_logger_name()
+        flash_id = session.get_flash_id()
+        vbatt = session.read_vbatt()
         print('Logger "{}" (ID={})'.format(logger_name, flash_id))
         print('Battery voltage: {:.1f} V'.format(vbatt))
         if vbatt < 2.2:
@@ -57,10 +59,10 @@ with Serial(PORT, 115200, timeout=1) as ser:
     # Stop logging if necessary
     logging.debug('Stop ongoing logging if necessary...')
     try:
-        if is_logging(ser):
+        if session.is_logging():
             r = input('Logger is already logging. Stop it first? (yes/no; DEFAULT=no)')
             if r.strip().lower() in ['yes']:
-                if not stop_logging(ser, maxretry=20):
+                if not session.stop_logging(maxretry=20):
                     logging.error('Logger is still logging and is not responding to stop_logging. Terminating.')
                     sys.exit()
             else:
@@ -71,11 +73,11 @@ with Serial(PORT, 115200, timeout=1) as ser:
         sys.exit()
 
     # Verify that it is indeed not logging
-    assert not is_logging(ser)
+    assert not session.is_logging()
 
 
     # Turn off LEDs
-    ser.write(b'red_led_off green_led_off blue_led_off')
+    session.send(b'red_led_off green_led_off blue_led_off')
 
 
     # Set RTC to current UTC time
@@ -106,8 +108,8 @@ with Serial(PORT, 115200, timeout=1) as ser:
     assert logging_interval_code in SAMPLE_INTERVAL_CODE_MAP
 
     for i in range(MAX_RETRY):
-        ser.write('set_logging_interval{}\n'.format(logging_interval_code).encode())
-        c = get_logging_config(ser)
+        session.send('set_logging_interval{}\n'.format(logging_interval_code).encode())
+        c = session.get_logging_config()
         if c['logging_interval_code'] == logging_interval_code:
             break
     else:
@@ -117,7 +119,7 @@ with Serial(PORT, 115200, timeout=1) as ser:
 
     # Check if memory is empty
 
-    is_memory_empty = find_last_used_page(ser) is None
+    is_memory_empty = find_last_used_page(ser, c) is None
 
     if not is_memory_empty:
         print('Memory is not empty.')
@@ -127,7 +129,7 @@ with Serial(PORT, 115200, timeout=1) as ser:
                 break
         if r.strip().lower() in ['yes']:
             logging.debug('User wants to wipe memory.')
-            ser.write(b'clear_memory')
+            session.send(b'clear_memory')
             THRESHOLD = 10
             cool = THRESHOLD
             while cool > 0:
@@ -160,9 +162,9 @@ with Serial(PORT, 115200, timeout=1) as ser:
 
     print('Attempting to start logging...')
     for i in range(MAX_RETRY):
-        ser.write(b'start_logging')
+        session.send(b'start_logging')
         time.sleep(0.1)
-        if is_logging(ser):
+        if session.is_logging():
             break
         else:
             logging.debug('... still not logging...')
@@ -173,7 +175,7 @@ with Serial(PORT, 115200, timeout=1) as ser:
     print('Logger is running.')
 
     # Record config and meta
-    tmp = get_logging_config(ser)
+    tmp = session.get_logging_config()
     logging_start_time = tmp['logging_start_time']
     
     config = {'start_logging_time':time.time(),
@@ -181,7 +183,7 @@ with Serial(PORT, 115200, timeout=1) as ser:
               'logger_name':logger_name,
               'logging_start_time': logging_start_time,
               'logging_interval_code': logging_interval_code,
-              'vbatt_pre': read_vbatt(ser),
+              'vbatt_pre': session.read_vbatt(),
               }
     
     config = json.dumps(config, separators=(',',':'))